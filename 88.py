@@ -1,187 +1,344 @@
-from openai import OpenAI
-
-# Set up OpenAI client with Nvidia API base URL
-client = OpenAI(
-  base_url="https://integrate.api.nvidia.com/v1",
-  api_key="nvidia api"
-)
-
-# Define prompt templates for different content types
-AI_PROMPTS = {
-    "analogy": """
-    Explain [Concept] using an analogy with something familiar. Make it:
-    - Easy to understand, avoiding technical terms or complexity
-    - Based on a common experience or idea
-    - Focused on key similarities and insights to make the concept relatable and clear.
-    """,
-    "description": """
-    Break down [Concept] in a simple, beginner-friendly way. Imagine it's being introduced for the first time. Make it:
-    - Brief, fun, and easy to follow
-    - Focused on the main idea and basic functionality.
-    """,
-    "codeSnippet": """
-    Create a concise code snippet to demonstrate [Programming Concept]. Make it:
-    - Short (under 20 lines) and syntactically correct
-    - Clear and practical, showcasing a specific use of the concept
-    - Commented with brief explanations for readability
-    Use [Programming Language] and provide a hands-on example for easy experimentation.
-    """,
-    "funfacts": """
-    Make learning [Concept] exciting with fun facts. Find:
-    - Intriguing or surprising details related to the concept
-    - Simple and memorable explanations
-    - Vivid descriptions or unexpected connections that spark curiosity
-    List 2-3 engaging fun facts to enhance enjoyment and retention.
-    """,
-    "quiz": """
-    Reinforce understanding of [Concept] with a short quiz. Include:
-    - Key questions that cover the concept's essentials
-    - Clear language and concise questions
-    - Answers with brief explanations to deepen understanding
-    Keep it engaging, informative, and balanced in difficulty.
-    """,
-    "assignment": """
-    Design a mini assignment to apply [Concept] practically. Make it:
-    - Simple and focused, taking under 30 minutes
-    - Centered on one main aspect of the concept
-    - Relevant to real-life or relatable scenarios
-    Help reinforce understanding by creating a hands-on task to apply [Concept].
-    """
-}
-
-# Define text prompt for content structure
-TEXT_PROMPT = """\
-Create a set of maximum {max_objects} card objects to provide {content_type} related to the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}". 
-Guidelines: 
-1. Card ID should follow the format: '{card_prefix}{{index}}-sub{{index}}' where the index starts from 1. 
-2. Each card's content should not exceed 6 lines. If needed, add additional content in a new card object. 
-3. The value of the content property should be of the same data type as provided in the schema/sample. 
-4. Use </br> after each sentence. 
-5. Use simple and easy-to-understand vocabulary. 
-6. Style content with HTML and inline styles for emphasis & key terms (e.g., <span style="color: red;">bold</span>, <span style="color: green;">colors</span>, <i>italic</i>). 
-7. Use only the element values available in the card render object. 
-8. If a {content_type} is irrelevant for the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}", provide output as an empty JSON object.
-"""
-CONTENT_TYPES_ARRAY = ["analogy", "description", "codeSnippet", "funfacts", "quiz", "assignment"]
-MAX_OBJECTS = {
-    "analogy": 1,
-    "description": 8,
-    "codeSnippet": 3,
-    "funfacts": 2,
-    "quiz": 6,
-    "assignment": 1
-}
-# Function to get OpenAI response based on a prompt
-def get_openai_response(prompt):
-    
-    completion = client.chat.completions.create(
-        model="nvidia/nemotron-4-340b-instruct",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        top_p=0.7,
-        max_tokens=1024,
-        stream=True
-    )
-
-    response = ""
-    for chunk in completion:
-        if chunk.choices[0].delta.content is not None:
-            response += chunk.choices[0].delta.content
-    return response.strip()
-
-# Function to generate array of subtopic objects with content
-def generate_subtopic_array(subject):
-    subtopic_array = []
-
-    for subtopic in subject["subtopics"]:
-        card_prefix = f"{subject['topic']}-{subtopic['name']}"
-        
-        for content_type in AI_PROMPTS.keys():
-            if content_type in subtopic:
-                # Combine AI_PROMPTS and TEXT_PROMPT for a detailed prompt
-                prompt = (
-                    TEXT_PROMPT.format(
-                        max_objects=6,  # Define max number of objects if needed
-                        content_type=content_type,
-                        subtopic=subtopic["name"],
-                        skill_name=subject["skill_name"],
-                        topic=subject["topic"],
-                        card_prefix=card_prefix
-                    ) + AI_PROMPTS[content_type].replace("[Concept]", subtopic["name"])
-                )
-                
-                response = get_openai_response(prompt)
-
-                # Append content based on content_type to subtopic array
-                if content_type == "analogy":
-                    subtopic_array.append({
-                        "analogy": {
-                            "cardId": f"{card_prefix}_analogy",
-                            "render": [
-                                {"element": "analogy", "about": f"An analogy explaining {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "description":
-                    subtopic_array.append({
-                        "description": {
-                            "cardId": f"{card_prefix}_description",
-                            "render": [
-                                {"element": "description", "about": f"Description of {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "codeSnippet":
-                    subtopic_array.append({
-                        "codeSnippet": {
-                            "cardId": f"{card_prefix}_codeSnippet",
-                            "render": [
-                                {"element": "codeSnippet", "about": f"Code example for {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "funfacts":
-                    subtopic_array.append({
-                        "funfacts": {
-                            "cardId": f"{card_prefix}_funfacts",
-                            "render": [
-                                {"element": "facts", "about": f"Fun facts about {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "quiz":
-                    subtopic_array.append({
-                        "quiz": {
-                            "cardId": f"{card_prefix}_quiz",
-                            "render": [
-                                {"element": "quiz", "about": f"Quiz on {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "assignment":
-                    subtopic_array.append({
-                        "assignment": {
-                            "cardId": f"{card_prefix}_assignment",
-                            "render": [
-                                {"element": "assignment", "about": f"Assignment for {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-    return subtopic_array
-
-# Sample subject input to test the function
-subject = {
-    "topic": "GPU Computing",
-    "skill_name": "Advanced Computing Skills",
-    "subtopics": [
-        {"name": "Parallel Processing", "analogy": True, "description": True, "codeSnippet": True, "funfacts": True, "quiz": True, "assignment": True},
-        {"name": "CUDA Programming", "description": True, "codeSnippet": True, "quiz": True},
-    ]
-}
-
-# Generate the subtopic array with responses
-subtopic_cards = generate_subtopic_array(subject)
-
-# Print the generated cards for inspection
-for card in subtopic_cards:
-    print(card)
+import asyncio
+import json
+import os
+
+from clients import get_async_client, get_client, is_connection_error
+from prompt_templates import TemplateRegistry
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache, completion_cache_key
+from streaming import StreamingResponse, is_empty_json_object
+
+# Limits for the concurrent card-generation engine
+MAX_CONCURRENT_REQUESTS = 16
+REQUEST_TIMEOUT = 120  # seconds, per model call
+
+# Generator model and sampling parameters, also used to key the response cache
+GENERATION_MODEL = "nvidia/nemotron-4-340b-instruct"
+GENERATION_PARAMS = {"temperature": 0.2, "top_p": 0.7, "max_tokens": 1024}
+
+# Shared rate limiter under every model call: request/token budgets per minute
+# (unlimited unless NVIDIA_RPM / NVIDIA_TPM are set), backoff and circuit breaking
+rate_limiter = RateLimiter(
+    requests_per_minute=int(os.environ.get("NVIDIA_RPM", 0)) or None,
+    tokens_per_minute=int(os.environ.get("NVIDIA_TPM", 0)) or None,
+    max_concurrency=MAX_CONCURRENT_REQUESTS,
+    retry_if=is_connection_error
+)
+
+# Persistent cache of model responses and reward scores, opened on first use
+response_cache = ResponseCache()
+
+# Define prompt templates for different content types
+AI_PROMPTS = {
+    "analogy": """
+    Explain [Concept] using an analogy with something familiar. Make it:
+    - Easy to understand, avoiding technical terms or complexity
+    - Based on a common experience or idea
+    - Focused on key similarities and insights to make the concept relatable and clear.
+    """,
+    "description": """
+    Break down [Concept] in a simple, beginner-friendly way. Imagine it's being introduced for the first time. Make it:
+    - Brief, fun, and easy to follow
+    - Focused on the main idea and basic functionality.
+    """,
+    "codeSnippet": """
+    Create a concise code snippet to demonstrate [Programming Concept]. Make it:
+    - Short (under 20 lines) and syntactically correct
+    - Clear and practical, showcasing a specific use of the concept
+    - Commented with brief explanations for readability
+    Use [Programming Language] and provide a hands-on example for easy experimentation.
+    """,
+    "funfacts": """
+    Make learning [Concept] exciting with fun facts. Find:
+    - Intriguing or surprising details related to the concept
+    - Simple and memorable explanations
+    - Vivid descriptions or unexpected connections that spark curiosity
+    List 2-3 engaging fun facts to enhance enjoyment and retention.
+    """,
+    "quiz": """
+    Reinforce understanding of [Concept] with a short quiz. Include:
+    - Key questions that cover the concept's essentials
+    - Clear language and concise questions
+    - Answers with brief explanations to deepen understanding
+    Keep it engaging, informative, and balanced in difficulty.
+    """,
+    "assignment": """
+    Design a mini assignment to apply [Concept] practically. Make it:
+    - Simple and focused, taking under 30 minutes
+    - Centered on one main aspect of the concept
+    - Relevant to real-life or relatable scenarios
+    Help reinforce understanding by creating a hands-on task to apply [Concept].
+    """
+}
+
+# Define text prompt for content structure
+TEXT_PROMPT = """\
+Create a set of maximum {max_objects} card objects to provide {content_type} related to the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}". 
+Guidelines: 
+1. Card ID should follow the format: '{card_prefix}{{index}}-sub{{index}}' where the index starts from 1. 
+2. Each card's content should not exceed 6 lines. If needed, add additional content in a new card object. 
+3. The value of the content property should be of the same data type as provided in the schema/sample. 
+4. Use </br> after each sentence. 
+5. Use simple and easy-to-understand vocabulary. 
+6. Style content with HTML and inline styles for emphasis & key terms (e.g., <span style="color: red;">bold</span>, <span style="color: green;">colors</span>, <i>italic</i>). 
+7. Use only the element values available in the card render object. 
+8. If a {content_type} is irrelevant for the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}", provide output as an empty JSON object.
+"""
+CONTENT_TYPES_ARRAY = ["analogy", "description", "codeSnippet", "funfacts", "quiz", "assignment"]
+MAX_OBJECTS = {
+    "analogy": 1,
+    "description": 8,
+    "codeSnippet": 3,
+    "funfacts": 2,
+    "quiz": 6,
+    "assignment": 1
+}
+
+# Programming language of codeSnippet cards when neither the subtopic nor the subject sets "language"
+DEFAULT_PROGRAMMING_LANGUAGE = "the programming language best suited to the concept"
+
+# Compiled prompt templates: one card template per content type (TEXT_PROMPT + AI_PROMPTS)
+prompt_templates = TemplateRegistry()
+for content_type, ai_prompt in AI_PROMPTS.items():
+    prompt_templates.register(content_type, TEXT_PROMPT + ai_prompt)
+# Rough size used to estimate the token budget of a request
+CHARS_PER_TOKEN = 4
+
+# Card render element and description for each content type
+CARD_RENDER = {
+    "analogy": ("analogy", "An analogy explaining {name}"),
+    "description": ("description", "Description of {name}"),
+    "codeSnippet": ("codeSnippet", "Code example for {name}"),
+    "funfacts": ("facts", "Fun facts about {name}"),
+    "quiz": ("quiz", "Quiz on {name}"),
+    "assignment": ("assignment", "Assignment for {name}")
+}
+
+# Function to estimate the number of tokens in a text
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# Function to build the response cache key of a generator prompt
+def get_completion_cache_key(prompt):
+    return completion_cache_key(
+        GENERATION_MODEL, prompt,
+        GENERATION_PARAMS["temperature"], GENERATION_PARAMS["top_p"], GENERATION_PARAMS["max_tokens"]
+    )
+
+# Function to estimate the tokens a generator call counts against the quota
+def estimate_generation_tokens(prompt):
+    return estimate_tokens(prompt) + GENERATION_PARAMS["max_tokens"]
+
+# Function to get OpenAI response based on a prompt.
+# stop_condition ends the stream early and on_delta sees the text as it streams in
+# (a retried call streams again from the start).
+def get_openai_response(prompt, stop_condition=None, on_delta=None):
+    cache_key = get_completion_cache_key(prompt)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    response = rate_limiter.call_sync(
+        lambda: stream_openai_response(prompt, stop_condition, on_delta),
+        estimate_generation_tokens(prompt)
+    )
+    response_cache.set(cache_key, response)
+    return response
+
+# Function to stream an OpenAI response with the sync client, closing the stream once stop_condition is met
+def stream_openai_response(prompt, stop_condition=None, on_delta=None):
+    completion = get_client().chat.completions.create(
+        model=GENERATION_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        **GENERATION_PARAMS
+    )
+
+    response = StreamingResponse(stop_condition, on_delta)
+    try:
+        for chunk in completion:
+            if chunk.choices[0].delta.content is not None and response.append(chunk.choices[0].delta.content):
+                break
+    finally:
+        completion.close()
+    return response.text.strip()
+
+# Function to stream an OpenAI response with the async client, closing the stream once stop_condition is met
+async def stream_openai_response_async(prompt, stop_condition=None, on_delta=None):
+    completion = await get_async_client().chat.completions.create(
+        model=GENERATION_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        **GENERATION_PARAMS
+    )
+
+    response = StreamingResponse(stop_condition, on_delta)
+    try:
+        async for chunk in completion:
+            if chunk.choices[0].delta.content is not None and response.append(chunk.choices[0].delta.content):
+                break
+    finally:
+        await completion.close()
+    return response.text.strip()
+
+# Function to get OpenAI response within the concurrency limit and timeout.
+# Cached responses are returned without waiting for a concurrency slot.
+async def get_openai_response_async(prompt, semaphore, timeout=REQUEST_TIMEOUT, stop_condition=None, on_delta=None):
+    cache_key = get_completion_cache_key(prompt)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    async with semaphore:
+        response = await rate_limiter.call(
+            lambda: asyncio.wait_for(stream_openai_response_async(prompt, stop_condition, on_delta), timeout),
+            estimate_generation_tokens(prompt)
+        )
+    response_cache.set(cache_key, response)
+    return response
+
+# Function to build the card ID prefix for a subtopic
+def get_card_prefix(subject, subtopic):
+    return f"{subject['topic']}-{subtopic['name']}"
+
+# Function to get the values bound to the placeholders of a card prompt
+def get_prompt_values(subject, subtopic, content_type):
+    return {
+        "max_objects": MAX_OBJECTS[content_type],
+        "content_type": content_type,
+        "subtopic": subtopic["name"],
+        "skill_name": subject["skill_name"],
+        "topic": subject["topic"],
+        "card_prefix": get_card_prefix(subject, subtopic),
+        "concept": subtopic["name"],
+        "programming_concept": subtopic["name"],
+        "programming_language": subtopic.get("language", subject.get("language", DEFAULT_PROGRAMMING_LANGUAGE))
+    }
+
+# Function to render the combined TEXT_PROMPT and AI_PROMPTS card prompt
+def build_prompt(subject, subtopic, content_type):
+    return prompt_templates.render(content_type, **get_prompt_values(subject, subtopic, content_type))
+
+# Function to get the stable fingerprint of a card prompt, for caching and deduplication
+def get_prompt_fingerprint(subject, subtopic, content_type):
+    return prompt_templates.fingerprint(content_type, **get_prompt_values(subject, subtopic, content_type))
+
+# Function to wrap generated content into the card object for its content type
+def build_card(card_prefix, subtopic, content_type, content):
+    element, about = CARD_RENDER[content_type]
+    return {
+        content_type: {
+            "cardId": f"{card_prefix}_{content_type}",
+            "render": [
+                {"element": element, "about": about.format(name=subtopic["name"]), "content": content}
+            ]
+        }
+    }
+
+# Function to generate array of subtopic objects with content
+def generate_subtopic_array(subject):
+    return list(iter_subtopic_cards(subject))
+
+# Function to yield the subtopic cards one by one as they are generated
+def iter_subtopic_cards(subject):
+    for subtopic in subject["subtopics"]:
+        card_prefix = get_card_prefix(subject, subtopic)
+        
+        for content_type in AI_PROMPTS.keys():
+            if content_type in subtopic:
+                prompt = build_prompt(subject, subtopic, content_type)
+                response = get_openai_response(prompt, is_empty_json_object)
+
+                # Yield content based on content_type
+                yield build_card(card_prefix, subtopic, content_type, response)
+
+# Function to generate the card of one (subtopic, content_type) unit
+async def generate_card_async(subject, subtopic, content_type, semaphore, timeout):
+    prompt = build_prompt(subject, subtopic, content_type)
+    response = await get_openai_response_async(prompt, semaphore, timeout, is_empty_json_object)
+    return build_card(get_card_prefix(subject, subtopic), subtopic, content_type, response)
+
+# Function to generate the subtopic array with every prompt fanned out at once.
+# The returned cards keep the same order as generate_subtopic_array.
+async def generate_subtopic_array_async(subject, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = [
+        asyncio.ensure_future(generate_card_async(subject, subtopic, content_type, semaphore, timeout))
+        for subtopic in subject["subtopics"]
+        for content_type in AI_PROMPTS.keys()
+        if content_type in subtopic
+    ]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+# Function to yield the subtopic cards as soon as each one is ready.
+# Units are scheduled lazily so at most max_concurrency are in flight at once,
+# which keeps time-to-first-card and memory independent of the subject size.
+# Cards arrive in completion order, not in subtopic_array order.
+async def iter_subtopic_cards_async(subject, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    units = (
+        (subtopic, content_type)
+        for subtopic in subject["subtopics"]
+        for content_type in AI_PROMPTS.keys()
+        if content_type in subtopic
+    )
+    pending = set()
+    try:
+        while True:
+            for subtopic, content_type in units:
+                pending.add(asyncio.ensure_future(generate_card_async(subject, subtopic, content_type, semaphore, timeout)))
+                if len(pending) >= max_concurrency:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Function to write cards to a JSON Lines file as they arrive, one card per line
+def write_cards_jsonl(cards, path):
+    count = 0
+    with open(path, "a", encoding="utf-8") as sink:
+        for card in cards:
+            sink.write(json.dumps(card, ensure_ascii=False) + "\n")
+            sink.flush()
+            count += 1
+    return count
+
+# Function to write cards from an async iterator to a JSON Lines file as they arrive
+async def write_cards_jsonl_async(cards, path):
+    count = 0
+    with open(path, "a", encoding="utf-8") as sink:
+        async for card in cards:
+            sink.write(json.dumps(card, ensure_ascii=False) + "\n")
+            sink.flush()
+            count += 1
+    return count
+
+# Sample subject input to test the function
+subject = {
+    "topic": "GPU Computing",
+    "skill_name": "Advanced Computing Skills",
+    "subtopics": [
+        {"name": "Parallel Processing", "analogy": True, "description": True, "codeSnippet": True, "funfacts": True, "quiz": True, "assignment": True},
+        {"name": "CUDA Programming", "description": True, "codeSnippet": True, "quiz": True},
+    ]
+}
+
+if __name__ == "__main__":
+    # Generate the subtopic array with responses
+    subtopic_cards = asyncio.run(generate_subtopic_array_async(subject))
+
+    # Print the generated cards for inspection
+    for card in subtopic_cards:
+        print(card)
+    print(f"Response cache: {response_cache.stats()}")
+    print(f"Rate limiter: {rate_limiter.stats()}")
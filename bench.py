@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import clients
+import scores
+from mock_server import MockConfig, MockServer
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+from scheduler import scheduling
+from tracing import percentile, tracer
+
+# Benchmark scenarios: card generation (async streaming, sync, structured per-type, fused
+# per-subtopic or through the quality gate), quiz pair scoring (async or sync), and single-card
+# interactive requests made while a bulk generation runs, in their own lane or in the bulk lane (fifo)
+SCENARIOS = [
+    "generate", "generate-sync", "generate-structured", "generate-fused", "generate-gated", "score", "score-sync", "mixed", "mixed-fifo"
+]
+GENERATE_SCENARIOS = ["generate", "generate-structured", "generate-fused", "generate-gated"]
+
+# Helpfulness threshold of the generate-gated scenario; the mock reward model scores uniformly in 0-4
+GATE_THRESHOLD = 2.0
+MIXED_SCENARIOS = ["mixed", "mixed-fifo"]
+
+# Interactive single-card requests made one after the other during a mixed scenario
+INTERACTIVE_REQUESTS = 10
+
+# Cards scored for quality: every content type except the quiz, whose responses are scored anyway
+QUIZ_CARD_KEYS = ["quiz", "question_response"]
+
+# Function to build a synthetic subject with n_subtopics subtopics enabling the given content types
+def build_subject(n_subtopics, content_types):
+    return {
+        "topic": "Benchmark",
+        "skill_name": "Benchmark Skills",
+        "subtopics": [
+            dict({"name": f"Subtopic {i + 1}"}, **{content_type: True for content_type in content_types})
+            for i in range(n_subtopics)
+        ]
+    }
+
+# Function to build n synthetic question-response cards for the scoring scenarios
+def build_question_response_cards(n_pairs):
+    return [
+        {"question_response": {"render": [{"content": {
+            "question": f"What is the key idea number {i + 1}?",
+            "responses": {"response_a": f"Answer A to question {i + 1}", "response_b": f"Answer B to question {i + 1}"}
+        }}]}}
+        for i in range(n_pairs)
+    ]
+
+# Function to get the peak resident set size of this process in MiB
+def get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# Function to point scores.py at the mock server with an empty cache and a fresh rate limiter.
+# Returns the list the latency of every model call (retries included) is recorded in.
+def configure_scores(base_url, cache_path, max_concurrency):
+    clients.configure(base_url=base_url, api_key="mock")
+    scores.response_cache = ResponseCache(cache_path)
+    scores.rate_limiter = RateLimiter(max_concurrency=max_concurrency, retry_if=clients.is_connection_error)
+
+    latencies = []
+    call, call_sync = scores.rate_limiter.call, scores.rate_limiter.call_sync
+
+    async def timed_call(request, estimated_tokens=0):
+        start = time.perf_counter()
+        try:
+            return await call(request, estimated_tokens)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    def timed_call_sync(request, estimated_tokens=0):
+        start = time.perf_counter()
+        try:
+            return call_sync(request, estimated_tokens)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    scores.rate_limiter.call = timed_call
+    scores.rate_limiter.call_sync = timed_call_sync
+    return latencies
+
+# Function to score generated cards with the reward model and return their mean helpfulness
+async def score_card_quality(cards, max_concurrency):
+    semaphore = scores.rate_limiter.create_semaphore(max_concurrency)
+    entries = [entry for card in cards for key, value in card.items() if key not in QUIZ_CARD_KEYS for entry in value["render"]]
+    card_scores = await scores.gather_or_cancel([
+        scores.get_response_and_scores_async(
+            clients.get_async_client(), scores.REWARD_MODEL, entry["about"], str(entry["content"]), semaphore
+        )
+        for entry in entries
+    ])
+    return sum(card_score["helpfulness"] for card_score in card_scores) / len(card_scores) if card_scores else None
+
+# Function to make single-card requests one after the other in the interactive lane, or queued
+# first-come first-served with the bulk calls when lanes is off, while a bulk generation runs
+# under the same semaphore. Returns the latency of each request.
+async def run_interactive_requests(subject, content_type, semaphore, lanes):
+    latencies = []
+    with scheduling(lane="interactive", tenant="interactive") if lanes else scheduling(lane="bulk", tenant="bulk"):
+        for i in range(INTERACTIVE_REQUESTS):
+            subtopic = {"name": f"Interactive {i + 1}", content_type: True}
+            start = time.perf_counter()
+            await scores.generate_cards_async(subject, subtopic, content_type, semaphore, scores.REQUEST_TIMEOUT)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+# Function to run one scenario and return (items produced, seconds to the first item, generated cards,
+# interactive request latencies)
+async def run_scenario(scenario, size, content_types, max_concurrency):
+    start = time.perf_counter()
+    first = None
+    items = 0
+    cards = []
+    interactive = []
+    scores.structured_output = scenario in ("generate-structured", "generate-fused")
+    scores.fused_output = scenario == "generate-fused"
+    scores.quality_threshold = GATE_THRESHOLD if scenario == "generate-gated" else None
+    if scenario in MIXED_SCENARIOS:
+        subject = build_subject(size, content_types)
+        clients.get_async_client()  # import openai before the requests are timed
+
+        semaphore = scores.rate_limiter.create_semaphore(max_concurrency)
+
+        async def run_bulk():
+            with scheduling(lane="bulk", tenant="bulk"):
+                return len(await scores.generate_subtopic_array_async(subject, semaphore=semaphore))
+
+        bulk = asyncio.ensure_future(run_bulk())
+        await asyncio.sleep(0)
+        interactive = await run_interactive_requests(subject, content_types[0], semaphore, scenario == "mixed")
+        items = await bulk + len(interactive)
+    elif scenario in GENERATE_SCENARIOS:
+        async for card in scores.iter_subtopic_cards_async(build_subject(size, content_types), max_concurrency):
+            first = first if first is not None else time.perf_counter() - start
+            items += 1
+            cards.append(card)
+    elif scenario == "generate-sync":
+        for _ in scores.iter_subtopic_cards(build_subject(size, content_types)):
+            first = first if first is not None else time.perf_counter() - start
+            items += 1
+    elif scenario == "score":
+        items = len(await scores.process_question_response_card_pairs_async(
+            build_question_response_cards(size), max_concurrency=max_concurrency
+        ))
+    else:
+        items = len(scores.process_question_response_card_pairs(build_question_response_cards(size)))
+    return items, first, cards, interactive
+
+# Function to run one scenario in this process and return its measurements
+def run_child(options):
+    with tempfile.TemporaryDirectory() as directory:
+        latencies = configure_scores(options["base_url"], os.path.join(directory, "cache.sqlite3"), options["max_concurrency"])
+        tracer.enable()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            items, first, cards, interactive = asyncio.run(run_scenario(
+                options["scenario"], options["size"], options["content_types"], options["max_concurrency"]
+            ))
+        seconds = time.perf_counter() - start
+        tracer.disable()
+        calls = len(latencies)
+        stages = tracer.get_metrics()["stages"]
+        quality = asyncio.run(score_card_quality(cards, options["max_concurrency"])) if options["quality"] else None
+        scores.response_cache.close()
+
+    return {
+        "scenario": options["scenario"],
+        "size": options["size"],
+        "items": items,
+        "calls": calls,
+        "seconds": round(seconds, 4),
+        "items_per_sec": round(items / seconds, 2) if seconds else None,
+        "time_to_first_item": round(first, 4) if first is not None else None,
+        "p50": round(percentile(latencies, 0.50), 4) if latencies else None,
+        "p95": round(percentile(latencies, 0.95), 4) if latencies else None,
+        "p99": round(percentile(latencies, 0.99), 4) if latencies else None,
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+        "retries": scores.rate_limiter.retries,
+        "tokens_in": sum(stages.get(stage, {}).get("tokens_in", 0) for stage in ("generate", "score")),
+        "tokens_out": stages.get("generate", {}).get("tokens_out"),
+        "fallbacks": sum(span.attributes.get("fallbacks", 0) for span in tracer.spans) if options["scenario"] == "generate-fused" else None,
+        "interactive_p95": round(percentile(interactive, 0.95), 4) if interactive else None,
+        "quality": round(quality, 3) if quality is not None else None
+    }
+
+# Function to print the benchmark results as a table
+def print_results(results):
+    columns = [
+        "scenario", "size", "items", "calls", "seconds", "items_per_sec", "time_to_first_item", "p50", "p95", "p99",
+        "peak_rss_mb", "retries", "tokens_in", "tokens_out", "fallbacks", "interactive_p95", "quality"
+    ]
+    rows = [[str(result[column]) if result[column] is not None else "-" for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+# Function to run the benchmark from the command line. Each (scenario, size) runs in its
+# own process against a shared mock server, so peak RSS is measured per run.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark against a mock endpoint.")
+    parser.add_argument("--sizes", default="1,5,20", help="comma-separated subtopic counts (pair counts for scoring)")
+    parser.add_argument("--scenarios", default="generate,score", help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--content-types", default=",".join(scores.AI_PROMPTS.keys()))
+    parser.add_argument("--max-concurrency", type=int, default=scores.MAX_CONCURRENT_REQUESTS)
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.002)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quality", action="store_true", help="score the generated cards with the reward model (not timed)")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child))))
+        return 0
+
+    config = MockConfig(
+        args.first_token_latency, args.token_latency, args.jitter, args.completion_tokens,
+        args.error_rate, args.rate_limit_rate, seed=args.seed
+    )
+    server = MockServer(config).start()
+    results = []
+    try:
+        for scenario in args.scenarios.split(","):
+            for size in [int(size) for size in args.sizes.split(",")]:
+                options = {
+                    "base_url": server.base_url,
+                    "scenario": scenario,
+                    "size": size,
+                    "content_types": args.content_types.split(","),
+                    "max_concurrency": args.max_concurrency,
+                    "quality": args.quality
+                }
+                child = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", json.dumps(options)],
+                    capture_output=True, text=True, check=True
+                )
+                results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+    finally:
+        server.stop()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+import json
+
+# orjson is optional: it parses several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Line that introduces the JSON schema at the end of a structured-output prompt
+SCHEMA_INSTRUCTION = "Respond with only a JSON object that matches this JSON schema, without any other text or code fences:"
+
+# Schema of the answer to one response prompt of a quiz
+RESPONSE_PAIR_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "response_a": {"type": "string", "minLength": 1},
+        "response_b": {"type": "string", "minLength": 1}
+    },
+    "required": ["response_a", "response_b"]
+}
+
+# Raised when a structured answer is not JSON or does not match its schema
+class SchemaValidationError(ValueError):
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+# Function to build the schema of a card answer holding at most max_objects card objects
+def get_card_schema(max_objects):
+    return {
+        "type": "object",
+        "properties": {
+            "cards": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": max_objects,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "cardId": {"type": "string", "minLength": 1},
+                        "content": {"type": "string", "minLength": 1}
+                    },
+                    "required": ["cardId", "content"]
+                }
+            }
+        },
+        "required": ["cards"]
+    }
+
+# Function to build the schema of the answer to a quiz question prompt
+def get_question_schema(n_questions):
+    return {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "minItems": n_questions,
+                "maxItems": n_questions,
+                "items": {"type": "string", "minLength": 1}
+            }
+        },
+        "required": ["questions"]
+    }
+
+# Function to build the schema of quiz items holding each question with its two responses
+def get_quiz_items_schema(n_questions):
+    return {
+        "type": "array",
+        "minItems": n_questions,
+        "maxItems": n_questions,
+        "items": {
+            "type": "object",
+            "properties": {
+                "question": {"type": "string", "minLength": 1},
+                "response_a": {"type": "string", "minLength": 1},
+                "response_b": {"type": "string", "minLength": 1}
+            },
+            "required": ["question", "response_a", "response_b"]
+        }
+    }
+
+# Function to build the schema of a batched quiz answer: every question with its two responses
+def get_quiz_schema(n_questions):
+    return {"type": "object", "properties": {"quiz": get_quiz_items_schema(n_questions)}, "required": ["quiz"]}
+
+# Function to build the schema of a fused answer: a list of card objects per content type
+# (empty when the type is irrelevant), and quiz items for the quiz
+def get_fused_schema(max_objects, n_questions):
+    properties = {}
+    for content_type, content_max_objects in max_objects.items():
+        if content_type == "quiz":
+            properties[content_type] = get_quiz_items_schema(n_questions)
+        else:
+            properties[content_type] = dict(get_card_schema(content_max_objects)["properties"]["cards"], minItems=0)
+    return {"type": "object", "properties": properties, "required": list(max_objects)}
+
+# Function to serialise a schema on one line for a prompt
+def dump_schema(schema):
+    return json.dumps(schema, separators=(",", ":"))
+
+# Function to parse JSON text with orjson when it is installed
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+# Function to cut the outermost JSON object out of a model answer, dropping code fences or chatter around it
+def extract_json(text):
+    start = text.find("{")
+    end = text.rfind("}")
+    if start < 0 or end < start:
+        raise SchemaValidationError(["the answer holds no complete JSON object"])
+    return text[start:end + 1]
+
+# Function to list the places where a value does not match a schema.
+# Covers the subset used by the card schemas: type, properties, required,
+# items, minItems, maxItems and minLength.
+def validate(value, schema, path="$"):
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            return [f"{path} must be an object"]
+        errors = [f"{path}.{key} is missing" for key in schema.get("required", []) if key not in value]
+        for key, property_schema in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(validate(value[key], property_schema, f"{path}.{key}"))
+        return errors
+    if expected == "array":
+        if not isinstance(value, list):
+            return [f"{path} must be an array"]
+        errors = []
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path} must hold at least {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            errors.append(f"{path} must hold at most {schema['maxItems']} items")
+        for index, item in enumerate(value):
+            errors.extend(validate(item, schema.get("items", {}), f"{path}[{index}]"))
+        return errors
+    if expected == "string":
+        if not isinstance(value, str):
+            return [f"{path} must be a string"]
+        if len(value.strip()) < schema.get("minLength", 0):
+            return [f"{path} must not be empty"]
+    return []
+
+# Function to parse and validate a structured answer, raising SchemaValidationError with every problem found.
+# With allow_empty an empty JSON object is accepted as "nothing to generate".
+def parse_structured(text, schema, allow_empty=False):
+    source = extract_json(text)
+    try:
+        value = loads(source)
+    except ValueError as error:
+        raise SchemaValidationError([f"the answer is not valid JSON ({error})"]) from error
+    if allow_empty and value == {}:
+        return value
+    errors = validate(value, schema)
+    if errors:
+        raise SchemaValidationError(errors)
+    return value
+
+# Function to parse a fused answer into the parts that match their schema, by content type.
+# Parts that are missing or invalid are left out so they can be generated on their own.
+def parse_fused(text, schema):
+    try:
+        answer = loads(extract_json(text))
+    except ValueError:
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+    return {
+        content_type: answer[content_type]
+        for content_type, part_schema in schema["properties"].items()
+        if content_type in answer and not validate(answer[content_type], part_schema, f"$.{content_type}")
+    }
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import sys
+import threading
+
+# Nvidia OpenAI-compatible endpoint, overridable with NVIDIA_BASE_URL / NVIDIA_API_KEY
+DEFAULT_BASE_URL = "https://integrate.api.nvidia.com/v1"
+DEFAULT_API_KEY = "nvidia api"
+
+# Connection pool shared by the generator and reward model calls
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 60  # seconds an idle connection is kept open
+
+# Function to tell whether httpx can negotiate HTTP/2 (the optional h2 package is installed)
+def is_http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+# Function to tell whether an error is an OpenAI connection error or timeout.
+# openai is only imported with the first client, so no such error exists before that.
+def is_connection_error(error):
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.APIConnectionError)
+
+# OpenAI clients created on first use over one keep-alive connection pool per client
+# kind, so importing the pipeline neither imports openai nor opens a connection.
+# Retries are left to the shared rate limiter, so the clients never retry themselves.
+# Async clients are bound to the event loop they were created in, and a new one is
+# created when a later asyncio.run() asks for it.
+class ClientPool:
+    def __init__(self, base_url=None, api_key=None, max_connections=MAX_CONNECTIONS,
+                 max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY):
+        self.base_url = base_url or os.environ.get("NVIDIA_BASE_URL", DEFAULT_BASE_URL)
+        self.api_key = api_key or os.environ.get("NVIDIA_API_KEY", DEFAULT_API_KEY)
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+        self._lock = threading.Lock()
+
+    # Function to get the httpx pool limits of the clients
+    def get_limits(self):
+        import httpx
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    # Function to get the shared sync client, creating it on first use
+    def get_client(self):
+        with self._lock:
+            if self._client is None:
+                import openai
+                self._client = openai.OpenAI(
+                    base_url=self.base_url,
+                    api_key=self.api_key,
+                    max_retries=0,
+                    http_client=openai.DefaultHttpxClient(limits=self.get_limits(), http2=is_http2_available())
+                )
+            return self._client
+
+    # Function to get the shared async client of the running event loop, creating it on first use
+    def get_async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._async_client is None or self._async_loop is not loop:
+                import openai
+                self._async_client = openai.AsyncOpenAI(
+                    base_url=self.base_url,
+                    api_key=self.api_key,
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(limits=self.get_limits(), http2=is_http2_available())
+                )
+                self._async_loop = loop
+            return self._async_client
+
+    # Function to close the sync client's connections
+    def close(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    # Function to close the async client's connections from its event loop
+    async def aclose(self):
+        with self._lock:
+            client, self._async_client, self._async_loop = self._async_client, None, None
+        if client is not None:
+            await client.close()
+
+# Shared pool used by the pipeline
+pool = ClientPool()
+
+# Function to point the shared pool at another endpoint, e.g. a mock server.
+# Clients already handed out keep their settings; later calls get new clients.
+def configure(base_url=None, api_key=None, **options):
+    global pool
+    pool.close()
+    pool = ClientPool(base_url, api_key, **options)
+    return pool
+
+# Function to get the shared sync client
+def get_client():
+    return pool.get_client()
+
+# Function to get the shared async client of the running event loop
+def get_async_client():
+    return pool.get_async_client()
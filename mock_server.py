@@ -0,0 +1,229 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Reward attributes returned by the mock reward model, in the order Nemotron returns them
+REWARD_ATTRIBUTES = ["helpfulness", "correctness", "coherence", "complexity", "verbosity"]
+
+# Latency, completion length and failure injection settings of the mock server
+class MockConfig:
+    def __init__(self, first_token_latency=0.05, token_latency=0.002, jitter=0.2, completion_tokens=120,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=None, seed=0, invalid_json_rate=0.0):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.invalid_json_rate = invalid_json_rate
+
+# Function to build a deterministic value matching a JSON schema, with strings derived from the prompt digest
+def get_schema_instance(schema, digest, path="item"):
+    if schema.get("type") == "object":
+        return {key: get_schema_instance(value, digest, key) for key, value in schema.get("properties", {}).items()}
+    if schema.get("type") == "array":
+        count = max(schema.get("minItems", 0), min(schema.get("maxItems", 2), 2))
+        return [get_schema_instance(schema.get("items", {}), digest, f"{path} {i + 1}") for i in range(count)]
+    return f"{path} {' '.join(digest[i:i + 4] for i in range(0, 24, 4))}"
+
+# Function to build the deterministic completion text for a prompt and temperature. Structured
+# prompts get JSON matching the schema they quote, cut in half when invalid is set.
+def get_completion_text(prompt, completion_tokens, invalid=False, temperature=None):
+    digest = hashlib.sha256(prompt.encode("utf-8") if temperature is None else f"{prompt}\0{temperature}".encode("utf-8")).hexdigest()
+    schema = re.search(r"matches this JSON schema[^\n]*\n(.+)", prompt)
+    if schema:
+        text = json.dumps(get_schema_instance(json.loads(schema.group(1)), digest))
+        return text[:len(text) // 2] if invalid else text
+    questions = re.search(r"generate (\d+) questions", prompt)
+    if questions:
+        return "\n".join(f"What is key idea {i + 1} of topic {digest[:8]}?" for i in range(int(questions.group(1))))
+    if "RESPONSE A:" in prompt:
+        half = max(1, completion_tokens // 2)
+        return f"RESPONSE A: {' '.join([digest[:6]] * half)}\nRESPONSE B: {' '.join([digest[-6:]] * half)}"
+    return " ".join(f"{digest[i % 60:i % 60 + 4]}</br>" if i % 12 == 11 else digest[i % 60:i % 60 + 4] for i in range(completion_tokens))
+
+# Function to split a completion into the deltas streamed to the client
+def split_tokens(text):
+    return re.findall(r"\S+\s*|\s+", text)
+
+# Function to build the reward-model response body with one logprob per attribute
+def get_reward_body(model, messages, rng):
+    scores = [(attribute, round(rng.uniform(0, 4), 3)) for attribute in REWARD_ATTRIBUTES]
+    return {
+        "id": "mock-reward",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": ",".join(f"{name}:{score}" for name, score in scores)},
+            "logprobs": {"content": [
+                {"token": name, "logprob": score, "bytes": None, "top_logprobs": []} for name, score in scores
+            ]},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": sum(len(m["content"].split()) for m in messages), "completion_tokens": len(scores), "total_tokens": 0}
+    }
+
+# Function to build one streamed chat-completion chunk
+def get_chunk(model, content=None, finish_reason=None):
+    delta = {} if content is None else {"role": "assistant", "content": content}
+    return {
+        "id": "mock-completion",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}]
+    }
+
+# Request handler speaking the chat-completions protocol over HTTP/1.1 keep-alive
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Function to keep the request log off stderr
+    def log_message(self, format, *args):
+        pass
+
+    # Function to answer a chat-completions request
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("content-length", 0)))
+        request = json.loads(body)
+        rng = self.server.get_rng(body)
+        config = self.server.config
+
+        if rng.random() < config.rate_limit_rate:
+            headers = {"retry-after": str(config.retry_after)} if config.retry_after is not None else {}
+            return self.send_json(429, {"error": {"message": "Too Many Requests", "type": "rate_limit", "code": 429}}, headers)
+        if rng.random() < config.error_rate:
+            return self.send_json(500, {"error": {"message": "Internal Server Error", "type": "server_error", "code": 500}})
+
+        time.sleep(self.server.get_delay(config.first_token_latency, rng))
+        if "reward" in request["model"]:
+            return self.send_json(200, get_reward_body(request["model"], request["messages"], rng))
+
+        prompt = request["messages"][-1]["content"]
+        completion_tokens = min(config.completion_tokens, request.get("max_tokens") or config.completion_tokens)
+        tokens = split_tokens(get_completion_text(prompt, completion_tokens, rng.random() < config.invalid_json_rate, request.get("temperature")))
+        if not request.get("stream"):
+            content = "".join(tokens)
+            return self.send_json(200, {
+                "id": "mock-completion", "object": "chat.completion", "created": int(time.time()), "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+            })
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        try:
+            for token in tokens:
+                self.send_event(get_chunk(request["model"], token))
+                time.sleep(self.server.get_delay(config.token_latency, rng))
+            self.send_event(get_chunk(request["model"], finish_reason="stop"))
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early
+            self.close_connection = True
+
+    # Function to send a JSON response with a content length
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Function to send one server-sent event
+    def send_event(self, payload):
+        self.send_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+    # Function to write one HTTP chunk; an empty chunk ends the response
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+# Deterministic stand-in for the Nvidia OpenAI-compatible endpoint. Streams chat
+# completions as server-sent events and answers reward-model calls with logprobs.
+# Latency, jitter, 5xx errors and 429s are drawn from a generator seeded with
+# (seed, request body, attempt), so a run is reproducible whatever the call order.
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), MockHandler)
+        self.config = config or MockConfig()
+        self.attempts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # Base URL to give the OpenAI clients
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    # Function to get the random generator of a request, seeded by its body and attempt number
+    def get_rng(self, body):
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            attempt = self.attempts.get(digest, 0)
+            self.attempts[digest] = attempt + 1
+        return random.Random(f"{self.config.seed}:{digest}:{attempt}")
+
+    # Function to draw a latency with the configured relative jitter
+    def get_delay(self, latency, rng):
+        return max(0.0, latency * (1 + rng.uniform(-self.config.jitter, self.config.jitter)))
+
+    # Function to serve requests from a background thread
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    # Function to stop serving and close the socket
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# Function to run the mock server from the command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deterministic mock of the Nvidia OpenAI-compatible endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--first-token-latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="seconds between streamed tokens")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative latency jitter, 0.2 = +/-20%%")
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0, help="fraction of structured answers cut short")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    config = MockConfig(
+        args.first_token_latency, args.token_latency, args.jitter, args.completion_tokens,
+        args.error_rate, args.rate_limit_rate, args.retry_after, args.seed, args.invalid_json_rate
+    )
+    server = MockServer(config, args.host, args.port)
+    print(f"Mock server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import functools
+import hashlib
+import re
+
+# Placeholders understood by the templates: str.format style {field} (with {{ and }}
+# as literal braces) and the [Title Case] placeholders of the AI_PROMPTS texts
+PLACEHOLDER_PATTERN = re.compile(r"\{\{|\}\}|\{(\w+)\}|\[([A-Z][A-Za-z]*(?: [A-Z][A-Za-z]*)*)\]")
+RENDER_CACHE_SIZE = 4096
+
+# Function to turn a [Title Case] placeholder into its field name, e.g. [Programming Language] -> programming_language
+def get_field_name(placeholder):
+    return placeholder.lower().replace(" ", "_")
+
+# Function to hash a rendered prompt into a stable fingerprint
+def prompt_fingerprint(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+# Prompt template parsed once into literal text and field segments
+class PromptTemplate:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.segments = []
+        self.fields = set()
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            literal = text[position:match.start()]
+            if match.group(0) in ("{{", "}}"):
+                literal += match.group(0)[0]
+                field = None
+            else:
+                field = match.group(1) or get_field_name(match.group(2))
+            if literal:
+                self.segments.append((False, literal))
+            if field is not None:
+                self.segments.append((True, field))
+                self.fields.add(field)
+            position = match.end()
+        if position < len(text):
+            self.segments.append((False, text[position:]))
+
+    # Function to render the template, raising ValueError when a placeholder is not bound
+    def render(self, values):
+        missing = self.fields - values.keys()
+        if missing:
+            raise ValueError(f"Unbound placeholders in prompt template {self.name!r}: {', '.join(sorted(missing))}")
+        return "".join(str(values[value]) if is_field else value for is_field, value in self.segments)
+
+# Registry of compiled prompt templates with a cache of rendered prompts
+class TemplateRegistry:
+    def __init__(self, cache_size=RENDER_CACHE_SIZE):
+        self.templates = {}
+        self._render_cached = functools.lru_cache(maxsize=cache_size)(self._render)
+
+    # Function to compile and register a template under a name
+    def register(self, name, text):
+        self.templates[name] = PromptTemplate(name, text)
+        self._render_cached.cache_clear()
+        return self.templates[name]
+
+    # Function to render a registered template from keyword values.
+    # Only the values the template uses are part of the render cache key.
+    def render(self, name, **values):
+        template = self.templates[name]
+        return self._render_cached(name, tuple(sorted((field, values[field]) for field in template.fields if field in values)))
+
+    # Function to render a registered template and return its fingerprint
+    def fingerprint(self, name, **values):
+        return prompt_fingerprint(self.render(name, **values))
+
+    # Function to render a template from the sorted (field, value) items of the cache key
+    def _render(self, name, items):
+        return self.templates[name].render(dict(items))
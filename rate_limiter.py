@@ -0,0 +1,311 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+
+from scheduler import LANES, FairSemaphore
+
+# Default retry and circuit breaker settings
+MAX_RETRIES = 6
+BASE_DELAY = 1.0  # seconds
+MAX_DELAY = 60.0  # seconds
+FAILURE_THRESHOLD = 8  # consecutive failed attempts before the circuit opens
+RESET_TIMEOUT = 30.0  # seconds the circuit stays open
+PROBE_POLL_INTERVAL = 0.1  # seconds a retrying call waits between checks while another call probes
+
+# Raised when a call is refused because the circuit is open
+class CircuitOpenError(Exception):
+    pass
+
+# Token bucket refilled at rate_per_minute, holding at most capacity tokens.
+# reserve() takes the tokens straight away and returns how long the caller has
+# to wait before using them, so waiting callers are served in arrival order.
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Function to take tokens from the bucket and return the wait in seconds
+    def reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+# Circuit breaker that opens after failure_threshold consecutive failures.
+# After reset_timeout one probe call is let through; its outcome closes or reopens the circuit.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    # Function to raise CircuitOpenError unless a call may go through, returning True for the probe call
+    def check(self):
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"circuit open after {self.failures} consecutive failures")
+            self.probing = True
+            return True
+
+    # Function to let another call probe after the probe ended without reaching the endpoint
+    # (cancelled, or failed while queued), leaving the failure count as it was
+    def abandon_probe(self):
+        with self._lock:
+            self.probing = False
+
+    # Function to get how long a retrying call waits before checking the open circuit again:
+    # the rest of the reset timeout, or a poll interval while another call probes
+    def get_wait(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(PROBE_POLL_INTERVAL, self.opened_at + self.reset_timeout - time.monotonic())
+
+    # Function to close the circuit after a call reached the endpoint
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    # Function to count a failed call, opening the circuit at the threshold. Once open, only
+    # a failed probe opens it again; calls sent before it opened do not extend it.
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and (self.opened_at is None or self.probing):
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+# Concurrency limit that halves when the endpoint throttles and grows by one
+# after a full window of successful calls (additive increase, multiplicative decrease).
+# Calls waiting for a slot are queued by lane, tenant and deadline (see scheduler.py),
+# and a freed slot is handed straight to the next queued call.
+class AdaptiveConcurrency(FairSemaphore):
+    def __init__(self, max_limit, min_limit=1):
+        super().__init__(max_limit)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.successes = 0
+
+    # Function to raise the limit by one after a full window of successes
+    def on_success(self):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self.successes = 0
+            self._wake()
+
+    # Function to halve the limit when the endpoint throttles
+    def on_throttle(self):
+        self.limit = max(self.min_limit, self.limit // 2)
+        self.successes = 0
+
+# Function to get the HTTP status code carried by an API error, if any
+def get_status_code(error):
+    return getattr(error, "status_code", None)
+
+# Function to read the Retry-After header of an API error, in seconds
+def get_retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+# Shared rate-limiting layer for one model endpoint: request and token buckets,
+# adaptive concurrency, retries with jittered exponential backoff on 429/5xx and
+# connection errors, and a circuit breaker. Limits of None disable that bucket.
+# Only 5xx and connection errors count toward the breaker: a 429 means the endpoint
+# is up but busy, which the backoff and the concurrency limit already handle.
+# A call that is already retrying waits for an open circuit to reset instead of failing.
+# Async calls take a concurrency slot before their request and token budget, so
+# queued interactive calls are not held up by budget reserved for queued bulk calls.
+# retry_if is an optional predicate marking further errors as retryable, for
+# error types that should not be imported up front.
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=64,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, retry_exceptions=(), retry_if=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.semaphores = weakref.WeakSet()
+        self.released_counts = {"expired": 0, "cancelled": 0}  # of semaphores already freed
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_exceptions = (ConnectionError, TimeoutError, asyncio.TimeoutError) + tuple(retry_exceptions)
+        self.retry_if = retry_if
+        self.retries = 0
+        self.throttled = 0
+
+    # Function to tell whether a failed call may succeed when retried
+    def is_retryable(self, error):
+        status_code = get_status_code(error)
+        if status_code is not None:
+            return status_code == 429 or status_code >= 500
+        return isinstance(error, self.retry_exceptions) or (self.retry_if is not None and self.retry_if(error))
+
+    # Function to compute the jittered exponential backoff of a retry attempt
+    def get_backoff(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # Function to wait for request and token budget before a call
+    def reserve(self, estimated_tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        return wait
+
+    # Function to record the outcome of a failed attempt and return the backoff, or None to give up
+    def on_failure(self, attempt, error):
+        if not self.is_retryable(error):
+            # The endpoint answered, so the error says nothing about its health
+            self.breaker.record_success()
+            return None
+        if get_status_code(error) == 429:
+            self.throttled += 1
+            self.concurrency.on_throttle()
+        else:
+            self.breaker.record_failure()
+        if attempt >= self.max_retries:
+            return None
+        self.retries += 1
+        return self.get_backoff(attempt, error)
+
+    # Function to wait until a retrying call may go through the circuit, returning True for the probe call.
+    # It waits out the reset timeout and the probe of another call, and gives up with
+    # CircuitOpenError once a probe failed and the circuit opened again.
+    async def wait_for_circuit(self):
+        opened_at = None
+        while True:
+            try:
+                return self.breaker.check()
+            except CircuitOpenError:
+                if opened_at is not None and self.breaker.opened_at != opened_at:
+                    raise
+                opened_at = self.breaker.opened_at
+                await asyncio.sleep(self.breaker.get_wait())
+
+    # Function to wait until a retrying blocking call may go through the circuit, returning True for the probe call
+    def wait_for_circuit_sync(self):
+        opened_at = None
+        while True:
+            try:
+                return self.breaker.check()
+            except CircuitOpenError:
+                if opened_at is not None and self.breaker.opened_at != opened_at:
+                    raise
+                opened_at = self.breaker.opened_at
+                time.sleep(self.breaker.get_wait())
+
+    # Function to run an async request factory under the rate limits, retrying transient failures
+    async def call(self, request, estimated_tokens=0):
+        attempt = 0
+        while True:
+            probe = await self.wait_for_circuit() if attempt else self.breaker.check()
+            try:
+                await self.concurrency.acquire(estimated_tokens)
+                try:
+                    wait = self.reserve(estimated_tokens)
+                    if wait:
+                        await asyncio.sleep(wait)
+                    result = await request()
+                except Exception as error:
+                    probe = False
+                    backoff = self.on_failure(attempt, error)
+                    if backoff is None:
+                        raise
+                else:
+                    probe = False
+                    self.breaker.record_success()
+                    self.concurrency.on_success()
+                    return result
+                finally:
+                    self.concurrency.release()
+            finally:
+                # A probe cancelled or failed in the queue has no outcome, so the next call probes instead
+                if probe:
+                    self.breaker.abandon_probe()
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+    # Function to run a blocking request factory under the rate limits, retrying transient failures
+    def call_sync(self, request, estimated_tokens=0):
+        attempt = 0
+        while True:
+            probe = self.wait_for_circuit_sync() if attempt else self.breaker.check()
+            try:
+                wait = self.reserve(estimated_tokens)
+                if wait:
+                    time.sleep(wait)
+                result = request()
+            except Exception as error:
+                probe = False
+                backoff = self.on_failure(attempt, error)
+                if backoff is None:
+                    raise
+            else:
+                probe = False
+                self.breaker.record_success()
+                return result
+            finally:
+                # A probe interrupted before it had an outcome lets the next call probe instead
+                if probe:
+                    self.breaker.abandon_probe()
+            time.sleep(backoff)
+            attempt += 1
+
+    # Function to create a semaphore bounding a run's calls on top of the limiter. Calls
+    # queued in it are scheduled like the limiter's own and covered by cancel and stats.
+    def create_semaphore(self, limit):
+        semaphore = FairSemaphore(limit)
+        self.semaphores.add(semaphore)
+        weakref.finalize(semaphore, self.on_semaphore_freed, semaphore.queue)
+        return semaphore
+
+    # Function to keep the counters of a freed semaphore's queue
+    def on_semaphore_freed(self, queue):
+        self.released_counts["expired"] += queue.expired
+        self.released_counts["cancelled"] += queue.cancelled
+
+    # Function to get the queues of the limiter and of the semaphores created from it
+    def get_queues(self):
+        return [self.concurrency.queue] + [semaphore.queue for semaphore in list(self.semaphores)]
+
+    # Function to fail the queued async calls of a lane and/or tenant with CallCancelledError,
+    # in the limiter and in its semaphores. Calls already sent are left to finish.
+    def cancel(self, lane=None, tenant=None):
+        return sum(queue.cancel(lane, tenant) for queue in self.get_queues())
+
+    # Function to report retry, throttling, concurrency and queue counters
+    def stats(self):
+        queues = self.get_queues()
+        return {
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "concurrency_limit": self.concurrency.limit,
+            "circuit_open": self.breaker.opened_at is not None,
+            "queued": {lane: sum(queue.depths()[lane] for queue in queues) for lane in LANES},
+            "expired": self.released_counts["expired"] + sum(queue.expired for queue in queues),
+            "cancelled": self.released_counts["cancelled"] + sum(queue.cancelled for queue in queues)
+        }
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Default location and limits of the persistent response cache
+CACHE_PATH = os.environ.get("CARD_CACHE_PATH", ".card_cache.sqlite3")
+CACHE_MAX_ENTRIES = 100_000
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+CACHE_EVICT_EVERY = 100  # writes between eviction passes
+
+# Function to hash the parts of a request into a stable cache key
+def make_cache_key(kind, *parts):
+    payload = json.dumps([kind, *parts], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Function to build the cache key of a generator model completion
+def completion_cache_key(model, prompt, temperature, top_p, max_tokens):
+    return make_cache_key("completion", model, prompt, temperature, top_p, max_tokens)
+
+# Function to build the cache key of a reward model score
+def score_cache_key(model, question, response):
+    return make_cache_key("score", model, question, response)
+
+# Disk-backed cache of model responses, keyed on a hash of the request.
+# Entries expire after ttl seconds and the least recently used entries are
+# evicted once the cache holds more than max_entries or max_bytes.
+# The database is opened on first use, not when the cache is created.
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.RLock()
+        self._connection = None
+
+    # Function to get the database connection, opening the database on first use
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "created REAL NOT NULL, accessed REAL NOT NULL)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+                self._connection = connection
+                self.evict()
+            return self._connection
+
+    # Function to get a cached value, or None on a miss
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    # Function to store a JSON-serialisable value
+    def set(self, key, value):
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now)
+            )
+            self._writes += 1
+            evict = self._writes % CACHE_EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    # Function to remove an entry, e.g. an answer that turned out to be unusable
+    def delete(self, key):
+        with self._lock:
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    # Function to drop expired entries, then least recently used ones over the limits
+    def evict(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            if entries <= self.max_entries and size <= self.max_bytes:
+                return
+            excess_entries = entries - self.max_entries
+            excess_bytes = size - self.max_bytes
+            doomed = []
+            for key, entry_size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                if excess_entries <= 0 and excess_bytes <= 0:
+                    break
+                doomed.append((key,))
+                excess_entries -= 1
+                excess_bytes -= entry_size
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    # Function to report hit/miss counters and the current cache size
+    def stats(self):
+        with self._lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    # Function to close the cache database
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import time
+
+# Priority lanes of model calls, served strictly in this order: interactive calls
+# take the next free slot, bulk calls use the capacity left over
+LANES = ["interactive", "bulk"]
+DEFAULT_LANE = "interactive"
+DEFAULT_TENANT = "default"
+
+# Raised in a queued call whose deadline passed before a slot was free
+class DeadlineExceededError(TimeoutError):
+    pass
+
+# Raised in a queued call that was cancelled before it was sent
+class CallCancelledError(Exception):
+    pass
+
+# Scheduling attributes of the calls made in a context: lane, tenant, tenant weight
+# and the time.monotonic() deadline by which a call must have left the queue
+class CallContext:
+    __slots__ = ("lane", "tenant", "weight", "deadline")
+
+    def __init__(self, lane=DEFAULT_LANE, tenant=DEFAULT_TENANT, weight=1.0, deadline=None):
+        if lane not in LANES:
+            raise ValueError(f"unknown lane {lane!r}, expected one of {', '.join(LANES)}")
+        self.lane = lane
+        self.tenant = tenant
+        self.weight = weight
+        self.deadline = deadline
+
+current_call = contextvars.ContextVar("current_call", default=CallContext())
+
+# Function to schedule the model calls made inside the block, and in tasks started from it,
+# in a lane and for a tenant. Unset arguments are inherited from the enclosing block.
+# timeout sets a deadline in seconds for each call to leave the queue.
+@contextlib.contextmanager
+def scheduling(lane=None, tenant=None, weight=None, timeout=None):
+    outer = current_call.get()
+    token = current_call.set(CallContext(
+        lane if lane is not None else outer.lane,
+        tenant if tenant is not None else outer.tenant,
+        weight if weight is not None else outer.weight,
+        time.monotonic() + timeout if timeout is not None else outer.deadline
+    ))
+    try:
+        yield
+    finally:
+        current_call.reset(token)
+
+# Queued call waiting for a concurrency slot
+class QueuedCall:
+    __slots__ = ("waiter", "context", "finish")
+
+    def __init__(self, waiter, context, finish):
+        self.waiter = waiter
+        self.context = context
+        self.finish = finish
+
+# Queue of waiting calls with one heap per lane. Within a lane, tenants share the
+# slots in proportion to their weight by weighted fair queuing: each call is tagged
+# with the virtual time at which its tenant's share of the lane would have served it,
+# and the smallest tag goes first. One tenant alone is served in arrival order.
+class FairQueue:
+    def __init__(self):
+        self.lanes = {lane: [] for lane in LANES}
+        self.virtual_time = {lane: 0.0 for lane in LANES}
+        self.tenant_finish = {}
+        self.expired = 0
+        self.cancelled = 0
+        self._sequence = itertools.count()
+
+    # Function to queue a call's waiter with its context and cost (estimated tokens)
+    def push(self, waiter, context, cost=1):
+        key = (context.lane, context.tenant)
+        start = max(self.virtual_time[context.lane], self.tenant_finish.get(key, 0.0))
+        finish = start + max(1, cost) / context.weight
+        self.tenant_finish[key] = finish
+        call = QueuedCall(waiter, context, finish)
+        heapq.heappush(self.lanes[context.lane], (finish, next(self._sequence), call))
+        return call
+
+    # Function to take the next live call: highest lane first, smallest tag within the lane.
+    # Calls that stopped waiting are skipped and calls whose deadline passed are failed on the way.
+    def pop(self):
+        now = time.monotonic()
+        for lane in LANES:
+            heap = self.lanes[lane]
+            while heap:
+                finish, _, call = heapq.heappop(heap)
+                if call.waiter.done():
+                    continue
+                if call.context.deadline is not None and call.context.deadline <= now:
+                    self.expire(call)
+                    continue
+                self.virtual_time[lane] = max(self.virtual_time[lane], finish)
+                return call
+        return None
+
+    # Function to fail a queued call whose deadline passed
+    def expire(self, call):
+        if not call.waiter.done():
+            self.expired += 1
+            call.waiter.set_exception(DeadlineExceededError(f"deadline passed while queued in the {call.context.lane} lane"))
+
+    # Function to fail the queued calls of a lane and/or tenant, returning how many were cancelled
+    def cancel(self, lane=None, tenant=None):
+        count = 0
+        for lane_name, heap in self.lanes.items():
+            if lane is not None and lane_name != lane:
+                continue
+            for _, _, call in heap:
+                if (tenant is None or call.context.tenant == tenant) and not call.waiter.done():
+                    call.waiter.set_exception(CallCancelledError(f"queued call of tenant {call.context.tenant!r} cancelled"))
+                    count += 1
+        self.cancelled += count
+        return count
+
+    # Function to count the queued calls per lane
+    def depths(self):
+        return {lane: sum(1 for _, _, call in heap if not call.waiter.done()) for lane, heap in self.lanes.items()}
+
+# Semaphore whose waiting calls are queued by lane, tenant and deadline instead of in
+# arrival order. A freed slot is handed straight to the next queued call, so a call
+# arriving in between cannot take it first.
+class FairSemaphore:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.queue = FairQueue()
+
+    # Function to wait for a free slot under the limit. cost (estimated tokens) weighs
+    # the call in its tenant's fair share; the lane, tenant and deadline come from the
+    # scheduling context of the caller.
+    async def acquire(self, cost=1):
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            return
+        loop = asyncio.get_running_loop()
+        call = self.queue.push(loop.create_future(), current_call.get(), cost)
+        timer = None
+        if call.context.deadline is not None:
+            timer = loop.call_later(max(0.0, call.context.deadline - time.monotonic()), self.queue.expire, call)
+        try:
+            await call.waiter
+        except asyncio.CancelledError:
+            # A slot handed over just before the task was cancelled goes to the next call
+            if call.waiter.done() and not call.waiter.cancelled() and call.waiter.exception() is None:
+                self.release()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    # Function to give a slot back and wake the next waiter
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    # Function to hand the free slots to the next queued calls
+    def _wake(self):
+        while self.in_flight < self.limit:
+            call = self.queue.pop()
+            if call is None:
+                return
+            self.in_flight += 1
+            call.waiter.set_result(None)
@@ -0,0 +1,309 @@
+import argparse
+import array
+import bisect
+import itertools
+import json
+import math
+import operator
+import sys
+
+# Reward attributes returned by the Nemotron reward model, in the order it returns them
+REWARD_ATTRIBUTES = ["helpfulness", "correctness", "coherence", "complexity", "verbosity"]
+RESPONSES = ["a", "b"]
+
+# First line of a saved score store, followed by a JSON header line, the raw columns
+# and the sorted columns and A-B differences (SCORES1 stores have no sorted sections)
+STORE_MAGIC = b"SCORES2\n"
+STORE_MAGIC_UNSORTED = b"SCORES1\n"
+COLUMN_TYPECODE = "f"  # float32: 4 bytes per attribute and response
+DIFFERENCE_TYPECODE = "d"  # A-B differences of float32 values need float64 to stay exact
+
+# Share of responses rejected by default when no explicit threshold is given
+DEFAULT_REJECT_QUANTILE = 0.1
+
+# Columnar store of the reward attributes of scored question-response pairs.
+# Each attribute of each response is one float32 array, so a pair's scores cost
+# 4 bytes per column (40 bytes for the five Nemotron attributes); its cardId
+# string, card_ids slot and rows entry add another 150-200 bytes in CPython.
+# Queries run over whole columns with C-level builtins instead of one dict per
+# pair. A missing attribute is stored as NaN.
+# Count, sum and sum of squares of every column are kept up to date as pairs
+# are added, and each column is sorted once on the first percentile query
+# after a change, so repeated queries do not rescan the columns. A saved store
+# keeps its moments and sorted columns, so queries after load need no sort.
+class ScoreStore:
+    def __init__(self, attributes=REWARD_ATTRIBUTES):
+        self.attributes = list(attributes)
+        self.card_ids = []
+        self.rows = {}
+        self.columns = {}
+        self.moments = {}
+        for attribute in self.attributes:
+            for response in RESPONSES:
+                self.columns[get_column_name(attribute, response)] = array.array(COLUMN_TYPECODE)
+                self.moments[get_column_name(attribute, response)] = [0, 0.0, 0.0]  # count, sum, sum of squares
+        self._sorted = {}
+
+    def __len__(self):
+        return len(self.card_ids)
+
+    # Function to add the scores of a pair, replacing the earlier scores of the same cardId
+    def add(self, card_id, scores_a, scores_b):
+        row = self.rows.get(card_id)
+        if row is None:
+            row = self.rows[card_id] = len(self.card_ids)
+            self.card_ids.append(card_id)
+            for column in self.columns.values():
+                column.append(math.nan)
+        for response, scores in zip(RESPONSES, (scores_a, scores_b)):
+            for attribute in self.attributes:
+                name = get_column_name(attribute, response)
+                column = self.columns[name]
+                self.update_moments(name, column[row], -1)
+                column[row] = scores.get(attribute, math.nan)
+                self.update_moments(name, column[row], 1)
+        self._sorted.clear()
+
+    # Function to add (sign 1) or remove (sign -1) a stored value from the moments of its column
+    def update_moments(self, name, value, sign):
+        if not math.isnan(value):
+            moments = self.moments[name]
+            moments[0] += sign
+            moments[1] += sign * value
+            moments[2] += sign * value * value
+
+    # Function to add the scores kept in question-response cards; cards scored without
+    # their reward attributes (or not scored at all) are skipped
+    def add_cards(self, cards):
+        for card in cards:
+            question_response = card.get("question_response")
+            if question_response is None:
+                continue
+            reward = question_response["render"][0].get("reward")
+            if reward is not None:
+                self.add(question_response["cardId"], reward["response_a"], reward["response_b"])
+        return self
+
+    # Function to get the column of an attribute of one response
+    def column(self, attribute, response):
+        return self.columns[get_column_name(attribute, response)]
+
+    # Function to get the sorted values of an attribute without NaN, of one response or of both
+    def sorted_values(self, attribute, response=None):
+        key = (attribute, response)
+        if key not in self._sorted:
+            if response is None:
+                values = sorted(self.sorted_values(attribute, "a") + self.sorted_values(attribute, "b"))
+            else:
+                values = sorted(self.column(attribute, response).tolist())
+                missing = len(values) - self.moments[get_column_name(attribute, response)][0]
+                # NaN sorts unpredictably, so columns with missing values are filtered first
+                if missing:
+                    values = sorted(value for value in values if not math.isnan(value))
+            self._sorted[key] = values
+        return self._sorted[key]
+
+    # Function to get the sorted differences between the A and B values of an attribute, without NaN
+    def sorted_differences(self, attribute):
+        key = ("difference", attribute)
+        if key not in self._sorted:
+            differences = sorted(map(operator.sub, self.column(attribute, "a"), self.column(attribute, "b")))
+            if any(map(math.isnan, differences)):
+                differences = sorted(difference for difference in differences if not math.isnan(difference))
+            self._sorted[key] = differences
+        return self._sorted[key]
+
+    # Function to get the share of pairs in which response A or B scores higher on an
+    # attribute by more than margin, and the share of ties, over the pairs with both scores
+    def win_rates(self, attribute="helpfulness", margin=0.0):
+        differences = self.sorted_differences(attribute)
+        count = len(differences)
+        if not count:
+            return {"a": None, "b": None, "tie": None}
+        wins_a = count - bisect.bisect_right(differences, margin)
+        wins_b = bisect.bisect_left(differences, -margin)
+        return {"a": wins_a / count, "b": wins_b / count, "tie": (count - wins_a - wins_b) / count}
+
+    # Function to summarise the distribution of an attribute: count, mean, standard deviation and percentiles
+    def describe(self, attribute="helpfulness", response=None):
+        values = self.sorted_values(attribute, response)
+        if not values:
+            return {"count": 0}
+        responses = RESPONSES if response is None else [response]
+        count, total, squares = (sum(moments) for moments in zip(*(self.moments[get_column_name(attribute, side)] for side in responses)))
+        mean = total / count
+        variance = max(0.0, squares / count - mean * mean)
+        return {
+            "count": count,
+            "mean": mean,
+            "std": math.sqrt(variance),
+            "min": values[0],
+            "p10": get_sorted_percentile(values, 0.10),
+            "p50": get_sorted_percentile(values, 0.50),
+            "p90": get_sorted_percentile(values, 0.90),
+            "max": values[-1]
+        }
+
+    # Function to count the values of an attribute in equal-width bins, returning (low, high, count) per bin
+    def histogram(self, attribute="helpfulness", bins=10, response=None):
+        values = self.sorted_values(attribute, response)
+        if not values:
+            return []
+        low, high = values[0], values[-1]
+        if low == high:
+            return [(low, high, len(values))]
+        width = (high - low) / bins
+        edges = [low + i * width for i in range(bins)] + [high]
+        counts = [bisect.bisect_left(values, edges[i + 1]) - bisect.bisect_left(values, edges[i]) for i in range(bins)]
+        counts[-1] += len(values) - bisect.bisect_left(values, high)
+        return [(edges[i], edges[i + 1], counts[i]) for i in range(bins)]
+
+    # Function to get the auto-reject threshold of an attribute: the value below which
+    # the given share of all responses falls
+    def get_threshold(self, attribute="helpfulness", quantile=DEFAULT_REJECT_QUANTILE):
+        return get_sorted_percentile(self.sorted_values(attribute), quantile)
+
+    # Function to count the responses scoring below a threshold on an attribute
+    def count_below(self, attribute, threshold):
+        return bisect.bisect_left(self.sorted_values(attribute), threshold)
+
+    # Function to list the (cardId, response) of every response scoring below a threshold
+    # on an attribute, the quantile threshold of the store when none is given
+    def reject(self, attribute="helpfulness", threshold=None, quantile=DEFAULT_REJECT_QUANTILE):
+        if threshold is None:
+            threshold = self.get_threshold(attribute, quantile)
+        if threshold is None:
+            return []
+        threshold = float(threshold)
+        return [
+            (card_id, response)
+            for response in RESPONSES
+            for card_id in itertools.compress(self.card_ids, map(threshold.__gt__, self.column(attribute, response)))
+        ]
+
+    # Function to build the analytics report of the store: win rates and distributions per
+    # attribute, and the auto-reject threshold and count of one attribute
+    def report(self, reject_attribute="helpfulness", quantile=DEFAULT_REJECT_QUANTILE):
+        threshold = self.get_threshold(reject_attribute, quantile)
+        return {
+            "pairs": len(self),
+            "win_rates": {attribute: self.win_rates(attribute) for attribute in self.attributes},
+            "distributions": {attribute: self.describe(attribute) for attribute in self.attributes},
+            "reject": {
+                "attribute": reject_attribute,
+                "quantile": quantile,
+                "threshold": threshold,
+                "responses": self.count_below(reject_attribute, threshold) if threshold is not None else 0
+            }
+        }
+
+    # Function to get the sorted sections a saved store keeps: (cache key, typecode, sorted values)
+    def get_sorted_sections(self):
+        sections = [
+            ((attribute, response), COLUMN_TYPECODE, self.sorted_values(attribute, response))
+            for attribute in self.attributes
+            for response in RESPONSES + [None]
+        ]
+        sections += [(("difference", attribute), DIFFERENCE_TYPECODE, self.sorted_differences(attribute)) for attribute in self.attributes]
+        return sections
+
+    # Function to write the store to a file: a JSON header with the cardIds and moments,
+    # the raw columns, then the sorted columns and differences so a loaded store needs no sort
+    def save(self, path):
+        sections = self.get_sorted_sections()
+        header = {
+            "attributes": self.attributes,
+            "typecode": COLUMN_TYPECODE,
+            "byteorder": sys.byteorder,
+            "card_ids": self.card_ids,
+            "moments": self.moments,
+            "sorted": [[list(key), typecode, len(values)] for key, typecode, values in sections]
+        }
+        with open(path, "wb") as output:
+            output.write(STORE_MAGIC)
+            output.write(json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n")
+            for column in self.columns.values():
+                column.tofile(output)
+            for _, typecode, values in sections:
+                array.array(typecode, values).tofile(output)
+
+    # Function to read a store written by save
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as source:
+            magic = source.readline()
+            if magic not in (STORE_MAGIC, STORE_MAGIC_UNSORTED):
+                raise ValueError(f"{path} is not a score store")
+            header = json.loads(source.readline())
+            store = cls(header["attributes"])
+            store.card_ids = header["card_ids"]
+            store.rows = dict(zip(store.card_ids, itertools.count()))
+            for name, column in store.columns.items():
+                store.columns[name] = read_array(source, column.typecode, len(store.card_ids), header["byteorder"])
+            if magic == STORE_MAGIC_UNSORTED:
+                for name, column in store.columns.items():
+                    values = [value for value in column.tolist() if not math.isnan(value)]
+                    store.moments[name] = [len(values), math.fsum(values), math.fsum(map(operator.mul, values, values))]
+                return store
+            store.moments = header["moments"]
+            # The sorted sections stay arrays: percentiles and bisect index them directly
+            for key, typecode, length in header["sorted"]:
+                store._sorted[tuple(key)] = read_array(source, typecode, length, header["byteorder"])
+        return store
+
+# Function to read an array of length values written on a machine of the given byte order
+def read_array(source, typecode, length, byteorder):
+    values = array.array(typecode)
+    values.fromfile(source, length)
+    if byteorder != sys.byteorder:
+        values.byteswap()
+    return values
+
+# Function to get the nearest-rank percentile of values that are already sorted
+def get_sorted_percentile(values, fraction):
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+# Function to get the name of the column of an attribute of one response, e.g. helpfulness_a
+def get_column_name(attribute, response):
+    return f"{attribute}_{response}"
+
+# Function to read the cards of a JSON Lines card file one by one
+def iter_cards_jsonl(path):
+    with open(path, encoding="utf-8") as source:
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+# Function to load a score store from a saved store or from a JSON Lines card file
+def load_score_store(path):
+    if path.endswith(".jsonl"):
+        return ScoreStore().add_cards(iter_cards_jsonl(path))
+    return ScoreStore.load(path)
+
+# Function to print the analytics report of a score store or card file from the command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report reward-model win rates, distributions and auto-reject thresholds.")
+    parser.add_argument("path", help="score store file, or JSON Lines card file")
+    parser.add_argument("--attribute", default="helpfulness", help="attribute the auto-reject threshold is computed on")
+    parser.add_argument("--reject-quantile", type=float, default=DEFAULT_REJECT_QUANTILE)
+    parser.add_argument("--threshold", type=float, help="reject responses below this value instead of the quantile")
+    parser.add_argument("--list-rejected", action="store_true", help="print the cardId and response of every rejected response")
+    parser.add_argument("--save", help="write the loaded scores to this score store file")
+    args = parser.parse_args(argv)
+
+    store = load_score_store(args.path)
+    if args.save:
+        store.save(args.save)
+    report = store.report(args.attribute, args.reject_quantile)
+    if args.threshold is not None:
+        report["reject"].update(threshold=args.threshold, responses=store.count_below(args.attribute, args.threshold))
+    print(json.dumps(report, indent=2))
+    if args.list_rejected:
+        for card_id, response in store.reject(args.attribute, report["reject"]["threshold"]):
+            print(f"{card_id}\tresponse_{response}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,323 +1,1713 @@
-from openai import OpenAI
-
-# Set up OpenAI client with Nvidia API base URL
-client = OpenAI(
-  base_url="https://integrate.api.nvidia.com/v1",
-  api_key="nvidia api"
-)
-
-# Define prompt templates for different content types
-AI_PROMPTS = {
-    "analogy": """
-    Explain [Concept] using an analogy with something familiar. Make it:
-    - Easy to understand, avoiding technical terms or complexity
-    - Based on a common experience or idea
-    - Focused on key similarities and insights to make the concept relatable and clear.
-    """,
-    "description": """
-    Break down [Concept] in a simple, beginner-friendly way. Imagine it's being introduced for the first time. Make it:
-    - Brief, fun, and easy to follow
-    - Focused on the main idea and basic functionality.
-    """,
-    "codeSnippet": """
-    Create a concise code snippet to demonstrate [Programming Concept]. Make it:
-    - Short (under 20 lines) and syntactically correct
-    - Clear and practical, showcasing a specific use of the concept
-    - Commented with brief explanations for readability
-    Use [Programming Language] and provide a hands-on example for easy experimentation.
-    """,
-    "funfacts": """
-    Make learning [Concept] exciting with fun facts. Find:
-    - Intriguing or surprising details related to the concept
-    - Simple and memorable explanations
-    - Vivid descriptions or unexpected connections that spark curiosity
-    List 2-3 engaging fun facts to enhance enjoyment and retention.
-    """,
-    "quiz": """
-    Reinforce understanding of [Concept] with a short quiz. Include:
-    - Key questions that cover the concept's essentials
-    - Clear language and concise questions
-    - Answers with brief explanations to deepen understanding
-    Keep it engaging, informative, and balanced in difficulty.
-    """,
-    "assignment": """
-    Design a mini assignment to apply [Concept] practically. Make it:
-    - Simple and focused, taking under 30 minutes
-    - Centered on one main aspect of the concept
-    - Relevant to real-life or relatable scenarios
-    Help reinforce understanding by creating a hands-on task to apply [Concept].
-    """
-}
-
-# Define text prompt for content structure
-TEXT_PROMPT = """\
-Create a set of maximum {max_objects} card objects to provide {content_type} related to the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}".
-Guidelines:
-1. Card ID should follow the format: '{card_prefix}{{index}}-sub{{index}}' where the index starts from 1.
-2. Each card's content should not exceed 6 lines. If needed, add additional content in a new card object.
-3. The value of the content property should be of the same data type as provided in the schema/sample.
-4. Use </br> after each sentence.
-5. Use simple and easy-to-understand vocabulary.
-6. Style content with HTML and inline styles for emphasis & key terms (e.g., <span style="color: red;">bold</span>, <span style="color: green;">colors</span>, <i>italic</i>).
-7. Use only the element values available in the card render object.
-8. If a {content_type} is irrelevant for the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}", provide output as an empty JSON object.
-"""
-
-CONTENT_TYPES_ARRAY = ["analogy", "description", "codeSnippet", "funfacts", "quiz", "assignment"]
-MAX_OBJECTS = {
-    "analogy": 1,
-    "description": 8,
-    "codeSnippet": 3,
-    "funfacts": 2,
-    "quiz": 6,
-    "assignment": 1
-}
-
-# Function to get OpenAI response based on a prompt
-def get_openai_response(prompt):
-    completion = client.chat.completions.create(
-        model="nvidia/nemotron-4-340b-instruct",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        top_p=0.7,
-        max_tokens=1024,
-        stream=True
-    )
-
-    response = ""
-    for chunk in completion:
-        if chunk.choices[0].delta.content is not None:
-            response += chunk.choices[0].delta.content
-    return response.strip()
-
-# Function to get response and scores using Nvidia reward model
-def get_response_and_scores(client, model, question, response_content):
-    messages = [
-        {
-            "role": "user",
-            "content": question
-        },
-        {
-            "role": "assistant",
-            "content": response_content
-        },
-    ]
-
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-    )
-
-    scores = get_scores_from_response(response)
-    return scores
-
-# Function to get scores from response
-def get_scores_from_response(openai_response_template):
-    logprobs = openai_response_template.choices[0].logprobs.content
-    score_dict = {}
-    for score in logprobs:
-        score_dict[score.token] = score.logprob
-    return score_dict
-
-# Function to process the question-response card pairs
-def process_question_response_card_pairs(question_response_cards):
-    # Initialize a list to store the processed question-response card pairs
-    processed_question_response_card_pairs = []
-
-    # Iterate over the question-response cards
-    for question_response_card in question_response_cards:
-        # Get the question and responses from the question-response card
-        question = question_response_card["question_response"]["render"][0]["content"]["question"]
-        response_a = question_response_card["question_response"]["render"][0]["content"]["responses"]["response_a"]
-        response_b = question_response_card["question_response"]["render"][0]["content"]["responses"]["response_b"]
-
-        # Get the scores for the responses using the Nvidia reward model
-        score_a = get_response_and_scores(client, "nvidia/nemotron-4-340b-reward", question, response_a)["helpfulness"]
-        score_b = get_response_and_scores(client, "nvidia/nemotron-4-340b-reward", question, response_b)["helpfulness"]
-
-        # Add the processed question-response card pair to the list
-        processed_question_response_card_pairs.append({
-            "question": question,
-            "response_a": response_a,
-            "score_a": score_a,
-            "response_b": response_b,
-            "score_b": score_b
-        })
-
-    # Return the list of processed question-response card pairs
-    return processed_question_response_card_pairs
-
-# Function to generate array of subtopic objects with content
-def generate_subtopic_array(subject):
-    subtopic_array = []
-
-    for subtopic in subject["subtopics"]:
-        card_prefix = f"{subject['topic']}-{subtopic['name']}"
-
-        for content_type in AI_PROMPTS.keys():
-            if content_type in subtopic:
-                # Combine AI_PROMPTS and TEXT_PROMPT for a detailed prompt
-                prompt = (
-                    TEXT_PROMPT.format(
-                        max_objects=6,  # Define max number of objects if needed
-                        content_type=content_type,
-                        subtopic=subtopic["name"],
-                        skill_name=subject["skill_name"],
-                        topic=subject["topic"],
-                        card_prefix=card_prefix
-                    ) + AI_PROMPTS[content_type].replace("[Concept]", subtopic["name"])
-                )
-
-                response = get_openai_response(prompt)
-
-                # Append content based on content_type to subtopic array
-                if content_type == "analogy":
-                    subtopic_array.append({
-                        "analogy": {
-                            "cardId": f"{card_prefix}_analogy",
-                            "render": [
-                                {"element": "analogy", "about": f"An analogy explaining {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "description":
-                    subtopic_array.append({
-                        "description": {
-                            "cardId": f"{card_prefix}_description",
-                            "render": [
-                                {"element": "description", "about": f"Description of {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "codeSnippet":
-                    subtopic_array.append({
-                        "codeSnippet": {
-                            "cardId": f"{card_prefix}_codeSnippet",
-                            "render": [
-                                {"element": "codeSnippet", "about": f"Code example for {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "funfacts":
-                    subtopic_array.append({
-                        "funfacts": {
-                            "cardId": f"{card_prefix}_funfacts",
-                            "render": [
-                                {"element": "facts", "about": f"Fun facts about {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-                elif content_type == "quiz":
-                    n_questions = 2
-                    # Generate questions for the subtopic
-                    QUESTION_PROMPT_TEMPLATE = """\
-                    Given a topic, generate {n_questions} questions that could be asked about that topic. Your response should be in a list format.
-
-                    The topic is: {sub_topic}
-
-                    The list must be without numbers. The questions should be separated by a newline character. There must be no other text than the list.
-                    """
-                    question_prompt = QUESTION_PROMPT_TEMPLATE.format(sub_topic=subtopic["name"], n_questions=n_questions)
-                    question_response = get_openai_response(question_prompt)
-                    questions = [question.strip() for question in question_response.split("\n") if question]
-
-                    # Generate responses for each question
-                    RESPONSE_PROMPT_TEMPLATE = """\
-                    Given a question, generate 2 responses that could be given to that question. Your response should be in a list format.
-
-                    The question is: {question}
-
-                    The list must be in the format:
-
-                    RESPONSE A: Response A text here
-                    RESPONSE B: Response B text here
-                    """
-                    quiz_content = []
-                    question_response_pair_list = []
-                    for question in questions:
-                        response_prompt = RESPONSE_PROMPT_TEMPLATE.format(question=question)
-                        response_set = get_openai_response(response_prompt)
-                        response_a = response_set.split("RESPONSE B:")[0].replace("RESPONSE A:", "").strip()
-                        response_b = response_set.split("RESPONSE B:")[-1].split("\n\n")[0].strip()
-
-                        quiz_content.append({
-                            "question": question,
-                            "responses": {
-                                "response_a": response_a,
-                                "response_b": response_b
-                            }
-                        })
-
-                        question_response_pair_list.append(
-                            {
-                                "question": question,
-                                "responses": {
-                                    "response_a": {"response": response_a},
-                                    "response_b": {"response": response_b}
-                                },
-                            }
-                        )
-
-                    subtopic_array.append({
-                        "quiz": {
-                            "cardId": f"{card_prefix}_quiz",
-                            "render": [
-                                {"element": "quiz", "about": f"Quiz on {subtopic['name']}", "content": quiz_content}
-                            ]
-                        }
-                    })
-
-                    # Generate question-response cards
-                    question_response_cards = []
-                    for i, question_response in enumerate(quiz_content):
-                        question_response_cards.append({
-                            "question_response": {
-                                "cardId": f"{card_prefix}_question_response_{i+1}",
-                                "render": [
-                                    {"element": "question_response", "about": f"Question-response card {i+1} for {subtopic['name']}", "content": question_response}
-                                ]
-                            }
-                        })
-
-                    subtopic_array.extend(question_response_cards)
-
-                    # Score the responses
-                    question_response_score_list = process_question_response_card_pairs(question_response_cards)
-
-                    # Add the scores to the question-response cards and print them
-                    for i, question_response in enumerate(question_response_score_list):
-                        question_response_cards[i]["question_response"]["render"][0]["score"] = {
-                            "response_a": question_response["score_a"],
-                            "response_b": question_response["score_b"]
-                        }
-                        # Print the card responses with scores
-                        print(f"Question: {question_response['question']}")
-                        print(f"Response A: {question_response['response_a']} (Score: {question_response['score_a']})")
-                        print(f"Response B: {question_response['response_b']} (Score: {question_response['score_b']})\n")
-                elif content_type == "assignment":
-                    subtopic_array.append({
-                        "assignment": {
-                            "cardId": f"{card_prefix}_assignment",
-                            "render": [
-                                {"element": "assignment", "about": f"Assignment for {subtopic['name']}", "content": response}
-                            ]
-                        }
-                    })
-    return subtopic_array
-
-# Sample subject input to test the function
-subject = {
-    "topic": "GPU Computing",
-    "skill_name": "Advanced Computing Skills",
-    "subtopics": [
-        {"name": "Parallel Processing", "analogy": True,  "assignment": True},
-        {"name": "CUDA Programming", "analogy": True, "codeSnippet": True, "quiz": True},
-    ]
-}
-
-# Generate the subtopic array with responses
-subtopic_cards = generate_subtopic_array(subject)
-
-# Print the generated cards for inspection
-for card in subtopic_cards:
-    print(card)
+import argparse
+import asyncio
+import collections
+import contextvars
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from card_schema import (
+    RESPONSE_PAIR_SCHEMA, SCHEMA_INSTRUCTION, SchemaValidationError, dump_schema, get_card_schema, get_fused_schema,
+    get_question_schema, get_quiz_schema, parse_fused, parse_structured
+)
+from clients import get_async_client, get_client, is_connection_error
+from prompt_templates import TemplateRegistry, prompt_fingerprint
+from rate_limiter import RateLimiter
+from scheduler import LANES, CallContext, current_call, scheduling
+from response_cache import ResponseCache, completion_cache_key, score_cache_key
+from score_store import ScoreStore, iter_cards_jsonl
+from streaming import StreamingResponse, is_empty_json_object, is_empty_json_text, is_json_complete, is_response_b_complete
+from tracing import percentile, tracer
+
+# Limits for the concurrent card-generation engine
+MAX_CONCURRENT_REQUESTS = 16
+REQUEST_TIMEOUT = 120  # seconds, per model call
+
+# Generator model and sampling parameters, also used to key the response cache
+GENERATION_MODEL = "nvidia/nemotron-4-340b-instruct"
+GENERATION_PARAMS = {"temperature": 0.2, "top_p": 0.7, "max_tokens": 1024}
+
+# Function to build the rate limiter of this process: request/token budgets per minute
+# (unlimited unless NVIDIA_RPM / NVIDIA_TPM are set), backoff and circuit breaking.
+# The budgets are split evenly when `shares` worker processes call the same endpoint.
+def build_rate_limiter(shares=1, max_concurrency=MAX_CONCURRENT_REQUESTS):
+    return RateLimiter(
+        requests_per_minute=int(os.environ.get("NVIDIA_RPM", 0)) / shares or None,
+        tokens_per_minute=int(os.environ.get("NVIDIA_TPM", 0)) / shares or None,
+        max_concurrency=max_concurrency,
+        retry_if=is_connection_error
+    )
+
+# Shared rate limiter under every model call
+rate_limiter = build_rate_limiter()
+
+# Persistent cache of model responses and reward scores, opened on first use
+response_cache = ResponseCache()
+
+# Nvidia reward model used to score quiz responses
+REWARD_MODEL = "nvidia/nemotron-4-340b-reward"
+
+# Define prompt templates for different content types
+AI_PROMPTS = {
+    "analogy": """
+    Explain [Concept] using an analogy with something familiar. Make it:
+    - Easy to understand, avoiding technical terms or complexity
+    - Based on a common experience or idea
+    - Focused on key similarities and insights to make the concept relatable and clear.
+    """,
+    "description": """
+    Break down [Concept] in a simple, beginner-friendly way. Imagine it's being introduced for the first time. Make it:
+    - Brief, fun, and easy to follow
+    - Focused on the main idea and basic functionality.
+    """,
+    "codeSnippet": """
+    Create a concise code snippet to demonstrate [Programming Concept]. Make it:
+    - Short (under 20 lines) and syntactically correct
+    - Clear and practical, showcasing a specific use of the concept
+    - Commented with brief explanations for readability
+    Use [Programming Language] and provide a hands-on example for easy experimentation.
+    """,
+    "funfacts": """
+    Make learning [Concept] exciting with fun facts. Find:
+    - Intriguing or surprising details related to the concept
+    - Simple and memorable explanations
+    - Vivid descriptions or unexpected connections that spark curiosity
+    List 2-3 engaging fun facts to enhance enjoyment and retention.
+    """,
+    "quiz": """
+    Reinforce understanding of [Concept] with a short quiz. Include:
+    - Key questions that cover the concept's essentials
+    - Clear language and concise questions
+    - Answers with brief explanations to deepen understanding
+    Keep it engaging, informative, and balanced in difficulty.
+    """,
+    "assignment": """
+    Design a mini assignment to apply [Concept] practically. Make it:
+    - Simple and focused, taking under 30 minutes
+    - Centered on one main aspect of the concept
+    - Relevant to real-life or relatable scenarios
+    Help reinforce understanding by creating a hands-on task to apply [Concept].
+    """
+}
+
+# Define text prompt for content structure
+TEXT_PROMPT = """\
+Create a set of maximum {max_objects} card objects to provide {content_type} related to the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}".
+Guidelines:
+1. Card ID should follow the format: '{card_prefix}{{index}}-sub{{index}}' where the index starts from 1.
+2. Each card's content should not exceed 6 lines. If needed, add additional content in a new card object.
+3. The value of the content property should be of the same data type as provided in the schema/sample.
+4. Use </br> after each sentence.
+5. Use simple and easy-to-understand vocabulary.
+6. Style content with HTML and inline styles for emphasis & key terms (e.g., <span style="color: red;">bold</span>, <span style="color: green;">colors</span>, <i>italic</i>).
+7. Use only the element values available in the card render object.
+8. If a {content_type} is irrelevant for the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}", provide output as an empty JSON object.
+"""
+
+CONTENT_TYPES_ARRAY = ["analogy", "description", "codeSnippet", "funfacts", "quiz", "assignment"]
+MAX_OBJECTS = {
+    "analogy": 1,
+    "description": 8,
+    "codeSnippet": 3,
+    "funfacts": 2,
+    "quiz": 6,
+    "assignment": 1
+}
+
+# Card render element and description for each content type
+CARD_RENDER = {
+    "analogy": ("analogy", "An analogy explaining {name}"),
+    "description": ("description", "Description of {name}"),
+    "codeSnippet": ("codeSnippet", "Code example for {name}"),
+    "funfacts": ("facts", "Fun facts about {name}"),
+    "quiz": ("quiz", "Quiz on {name}"),
+    "assignment": ("assignment", "Assignment for {name}")
+}
+
+# Prompt templates for the quiz question/response pairs
+QUESTION_PROMPT_TEMPLATE = """\
+Given a topic, generate {n_questions} questions that could be asked about that topic. Your response should be in a list format.
+
+The topic is: {sub_topic}
+
+The list must be without numbers. The questions should be separated by a newline character. There must be no other text than the list.
+"""
+
+RESPONSE_PROMPT_TEMPLATE = """\
+Given a question, generate 2 responses that could be given to that question. Your response should be in a list format.
+
+The question is: {question}
+
+The list must be in the format:
+
+RESPONSE A: Response A text here
+RESPONSE B: Response B text here
+"""
+
+# Structured-output mode (--structured): the card and quiz prompts ask for JSON matching
+# a schema, and an answer that fails validation is repaired on its own
+structured_output = False
+MAX_REPAIR_ATTEMPTS = 2
+
+# Schema of the card objects of each content type, limited to its MAX_OBJECTS
+CARD_SCHEMAS = {content_type: get_card_schema(max_objects) for content_type, max_objects in MAX_OBJECTS.items()}
+CARD_SCHEMA_TEXTS = {content_type: dump_schema(schema) for content_type, schema in CARD_SCHEMAS.items()}
+
+# Instruction appended to the prompts of the structured-output mode
+STRUCTURED_OUTPUT_PROMPT = f"""
+{SCHEMA_INSTRUCTION}
+{{schema}}
+"""
+
+QUESTION_JSON_PROMPT_TEMPLATE = """\
+Given a topic, generate {n_questions} questions that could be asked about that topic.
+
+The topic is: {sub_topic}
+""" + STRUCTURED_OUTPUT_PROMPT
+
+RESPONSE_JSON_PROMPT_TEMPLATE = """\
+Given a question, generate 2 responses that could be given to that question.
+
+The question is: {question}
+""" + STRUCTURED_OUTPUT_PROMPT
+
+# Structured prompt for a whole quiz in one call: every question with its two responses
+QUIZ_BATCH_PROMPT_TEMPLATE = """\
+Given a topic, generate {n_questions} questions that could be asked about that topic, each with 2 different responses that could be given to that question.
+
+The topic is: {sub_topic}
+""" + STRUCTURED_OUTPUT_PROMPT
+
+# Prompt asking the model to fix one structured answer that failed validation
+REPAIR_PROMPT_TEMPLATE = """\
+{prompt}
+Your previous answer was:
+{response}
+
+It does not match the schema: {errors}.
+Answer again with only the corrected JSON object.
+"""
+
+# Fused mode (--fused): every requested content type of a subtopic in one structured
+# call, with the TEXT_PROMPT guidelines stated once instead of once per content type
+fused_output = False
+FUSED_CONTENT_TYPE = "fused"
+FUSED_MAX_TOKENS = 4096
+
+FUSED_PROMPT_TEMPLATE = """\
+Create card objects for each content type below, related to the subtopic "{subtopic}" of "{skill_name}" under the topic "{topic}".
+Guidelines:
+1. Card ID should follow the format: '{card_prefix}{{index}}-sub{{index}}' where the index starts from 1.
+2. Each card's content should not exceed 6 lines. If needed, add additional content in a new card object.
+3. Use </br> after each sentence.
+4. Use simple and easy-to-understand vocabulary.
+5. Style content with HTML and inline styles for emphasis & key terms (e.g., <span style="color: red;">bold</span>, <span style="color: green;">colors</span>, <i>italic</i>).
+6. If a content type is irrelevant for the subtopic "{subtopic}", give it an empty list.
+
+{sections}
+""" + STRUCTURED_OUTPUT_PROMPT
+
+# Heading of each content type's section of a fused prompt
+FUSED_SECTION_TEMPLATE = "{content_type} (at most {max_objects} card objects):"
+FUSED_QUIZ_SECTION_TEMPLATE = "quiz ({n_questions} questions, each with two different responses):"
+
+# Quality gate (--quality-gate): every text card is scored with the reward model as soon as it
+# is generated and regenerated while its mean helpfulness is below quality_threshold
+quality_threshold = None
+QUALITY_MAX_CANDIDATES = 3  # candidates generated per card, the first included
+QUALITY_TEMPERATURE_STEP = 0.3  # added to the temperature of each later candidate so it differs
+QUALITY_MAX_TEMPERATURE = 1.0
+
+# A candidate still generating after this percentile of recent candidate generation times
+# is hedged with a second one, once enough candidates have been measured. Only time at the
+# endpoint counts: waits for a concurrency slot and reward scoring are left out, so a
+# saturated run does not hedge every queued candidate, and cache hits are not measured.
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 8
+candidate_latencies = collections.deque(maxlen=256)
+
+# Candidate number of the generator calls made in the current context, 0 for the first
+generation_candidate = contextvars.ContextVar("generation_candidate", default=0)
+
+# Time the generator calls of one quality gate candidate spent at the endpoint
+class CandidateTiming:
+    __slots__ = ("endpoint_seconds", "sent_at", "requests", "generated")
+
+    def __init__(self):
+        self.endpoint_seconds = 0.0
+        self.sent_at = None  # perf_counter() time of the call at the endpoint now, if any
+        self.requests = 0
+        self.generated = False
+
+    # Function to mark a generator call as sent, once it holds its concurrency slot
+    def start(self):
+        self.sent_at = time.perf_counter()
+
+    # Function to mark the generator call as answered (or failed)
+    def stop(self):
+        self.endpoint_seconds += time.perf_counter() - self.sent_at
+        self.sent_at = None
+        self.requests += 1
+
+    # Function to get the seconds spent at the endpoint so far
+    def get_endpoint_seconds(self):
+        if self.sent_at is None:
+            return self.endpoint_seconds
+        return self.endpoint_seconds + time.perf_counter() - self.sent_at
+
+# Timing of the current quality gate candidate, None outside a candidate
+candidate_timing = contextvars.ContextVar("candidate_timing", default=None)
+
+# Programming language of codeSnippet cards when neither the subtopic nor the subject sets "language"
+DEFAULT_PROGRAMMING_LANGUAGE = "the programming language best suited to the concept"
+
+# Compiled prompt templates: one card template per content type (TEXT_PROMPT + AI_PROMPTS),
+# the quiz question/response templates and their structured-output variants
+prompt_templates = TemplateRegistry()
+for content_type, ai_prompt in AI_PROMPTS.items():
+    prompt_templates.register(content_type, TEXT_PROMPT + ai_prompt)
+    prompt_templates.register(f"structured:{content_type}", TEXT_PROMPT + ai_prompt + STRUCTURED_OUTPUT_PROMPT)
+prompt_templates.register("question", QUESTION_PROMPT_TEMPLATE)
+prompt_templates.register("response", RESPONSE_PROMPT_TEMPLATE)
+prompt_templates.register("question_json", QUESTION_JSON_PROMPT_TEMPLATE)
+prompt_templates.register("response_json", RESPONSE_JSON_PROMPT_TEMPLATE)
+prompt_templates.register("quiz_batch", QUIZ_BATCH_PROMPT_TEMPLATE)
+prompt_templates.register("repair", REPAIR_PROMPT_TEMPLATE)
+prompt_templates.register(FUSED_CONTENT_TYPE, FUSED_PROMPT_TEMPLATE)
+for content_type, ai_prompt in AI_PROMPTS.items():
+    section = FUSED_QUIZ_SECTION_TEMPLATE if content_type == "quiz" else FUSED_SECTION_TEMPLATE
+    prompt_templates.register(f"section:{content_type}", section + ai_prompt)
+
+# Number of questions generated for each quiz, unless the subtopic or subject sets "n_questions"
+QUIZ_QUESTIONS = 2
+# Completion budget of each question with its responses in a batched quiz call
+QUIZ_ITEM_MAX_TOKENS = 384
+
+# Rough sizes used to estimate the token budget of a generation plan
+CHARS_PER_TOKEN = 4
+ESTIMATED_QUESTION_TOKENS = 32
+ESTIMATED_RESPONSE_TOKENS = 128
+REWARD_OUTPUT_TOKENS = 32
+
+# Function to get the sampling parameters of a generator call, optionally with another max_tokens.
+# Later quality-gate candidates are sampled at a higher temperature, which also gives them their own cache entries.
+def get_generation_params(max_tokens=None):
+    params = dict(GENERATION_PARAMS, max_tokens=max_tokens or GENERATION_PARAMS["max_tokens"])
+    candidate = generation_candidate.get()
+    if candidate:
+        params["temperature"] = min(QUALITY_MAX_TEMPERATURE, params["temperature"] + candidate * QUALITY_TEMPERATURE_STEP)
+    return params
+
+# Function to build the response cache key of a generator prompt
+def get_completion_cache_key(prompt, max_tokens=None):
+    params = get_generation_params(max_tokens)
+    return completion_cache_key(GENERATION_MODEL, prompt, params["temperature"], params["top_p"], params["max_tokens"])
+
+# Function to estimate the tokens a generator call counts against the quota
+def estimate_generation_tokens(prompt, max_tokens=None):
+    return estimate_tokens(prompt) + get_generation_params(max_tokens)["max_tokens"]
+
+# Function to get OpenAI response based on a prompt.
+# stop_condition ends the stream early and on_delta sees the text as it streams in
+# (a retried call streams again from the start). max_tokens overrides GENERATION_PARAMS.
+def get_openai_response(prompt, stop_condition=None, on_delta=None, max_tokens=None):
+    with tracer.span("generate") as span:
+        cache_key = get_completion_cache_key(prompt, max_tokens)
+        cached_response = response_cache.get(cache_key)
+        span.set("cache_hit", cached_response is not None)
+        if cached_response is not None:
+            return cached_response
+
+        timing = candidate_timing.get()
+        if timing is not None:
+            timing.start()
+        try:
+            response = rate_limiter.call_sync(
+                lambda: stream_openai_response(prompt, stop_condition, on_delta, max_tokens),
+                estimate_generation_tokens(prompt, max_tokens)
+            )
+        finally:
+            if timing is not None:
+                timing.stop()
+        record_generation_tokens(span, prompt, response)
+        response_cache.set(cache_key, response)
+        return response
+
+# Function to record the estimated prompt and completion tokens of a model call on its span
+def record_generation_tokens(span, prompt, response):
+    span.set("tokens_in", estimate_tokens(prompt))
+    span.set("tokens_out", estimate_tokens(response))
+
+# Function to record the time to first token and early stop of one streamed attempt on the current span
+def record_stream_attempt(start, response):
+    span = tracer.current()
+    span.add("attempts")
+    if response.first_delta_time is not None:
+        span.set("ttft", response.first_delta_time - start)
+    span.set("stopped_early", response.stopped)
+
+# Function to stream an OpenAI response with the sync client, closing the stream once stop_condition is met
+def stream_openai_response(prompt, stop_condition=None, on_delta=None, max_tokens=None):
+    start = time.perf_counter()
+    completion = get_client().chat.completions.create(
+        model=GENERATION_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        **get_generation_params(max_tokens)
+    )
+
+    response = StreamingResponse(stop_condition, on_delta)
+    try:
+        for chunk in completion:
+            if chunk.choices[0].delta.content is not None and response.append(chunk.choices[0].delta.content):
+                break
+    finally:
+        completion.close()
+        record_stream_attempt(start, response)
+    return response.text.strip()
+
+# Function to stream an OpenAI response with the async client, closing the stream once stop_condition is met
+async def stream_openai_response_async(prompt, stop_condition=None, on_delta=None, max_tokens=None):
+    start = time.perf_counter()
+    completion = await get_async_client().chat.completions.create(
+        model=GENERATION_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        **get_generation_params(max_tokens)
+    )
+
+    response = StreamingResponse(stop_condition, on_delta)
+    try:
+        async for chunk in completion:
+            if chunk.choices[0].delta.content is not None and response.append(chunk.choices[0].delta.content):
+                break
+    finally:
+        await completion.close()
+        record_stream_attempt(start, response)
+    return response.text.strip()
+
+# Function to get OpenAI response within the concurrency limit and timeout.
+# Cached responses are returned without waiting for a concurrency slot.
+# semaphore comes from rate_limiter.create_semaphore, so queued calls are served by lane and tenant.
+async def get_openai_response_async(prompt, semaphore, timeout=REQUEST_TIMEOUT, stop_condition=None, on_delta=None, max_tokens=None):
+    with tracer.span("generate") as span:
+        cache_key = get_completion_cache_key(prompt, max_tokens)
+        cached_response = response_cache.get(cache_key)
+        span.set("cache_hit", cached_response is not None)
+        if cached_response is not None:
+            return cached_response
+
+        estimated_tokens = estimate_generation_tokens(prompt, max_tokens)
+        queued = time.perf_counter()
+        await semaphore.acquire(estimated_tokens)
+        timing = candidate_timing.get()
+        if timing is not None:
+            timing.start()
+        try:
+            span.set("queue_seconds", time.perf_counter() - queued)
+            response = await rate_limiter.call(
+                lambda: asyncio.wait_for(stream_openai_response_async(prompt, stop_condition, on_delta, max_tokens), timeout),
+                estimated_tokens
+            )
+        finally:
+            if timing is not None:
+                timing.stop()
+            semaphore.release()
+        record_generation_tokens(span, prompt, response)
+        response_cache.set(cache_key, response)
+        return response
+
+# Function to run awaitables concurrently, cancelling the rest if one fails.
+# Results are returned in the order the awaitables were given.
+async def gather_or_cancel(awaitables):
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+# Function to get response and scores using Nvidia reward model
+def get_response_and_scores(client, model, question, response_content):
+    with tracer.span("score") as span:
+        return score_response(client, model, question, response_content, span)
+
+# Function to score a response with the sync client, recording cache hits and attempts on span
+def score_response(client, model, question, response_content, span):
+    cache_key = score_cache_key(model, question, response_content)
+    cached_scores = response_cache.get(cache_key)
+    span.set("cache_hit", cached_scores is not None)
+    if cached_scores is not None:
+        return cached_scores
+
+    messages = [
+        {
+            "role": "user",
+            "content": question
+        },
+        {
+            "role": "assistant",
+            "content": response_content
+        },
+    ]
+
+    def request():
+        span.add("attempts")
+        return client.chat.completions.create(
+            model=model,
+            messages=messages,
+        )
+
+    span.set("tokens_in", estimate_tokens(question + response_content))
+    response = rate_limiter.call_sync(request, estimate_tokens(question + response_content) + REWARD_OUTPUT_TOKENS)
+
+    scores = get_scores_from_response(response)
+    response_cache.set(cache_key, scores)
+    return scores
+
+# Function to get response and scores using Nvidia reward model with the async client
+async def get_response_and_scores_async(async_client, model, question, response_content, semaphore, timeout=REQUEST_TIMEOUT):
+    with tracer.span("score") as span:
+        return await score_response_async(async_client, model, question, response_content, semaphore, timeout, span)
+
+# Function to score a response with the async client, recording cache hits and attempts on span
+async def score_response_async(async_client, model, question, response_content, semaphore, timeout, span):
+    cache_key = score_cache_key(model, question, response_content)
+    cached_scores = response_cache.get(cache_key)
+    span.set("cache_hit", cached_scores is not None)
+    if cached_scores is not None:
+        return cached_scores
+
+    messages = [
+        {
+            "role": "user",
+            "content": question
+        },
+        {
+            "role": "assistant",
+            "content": response_content
+        },
+    ]
+
+    def request():
+        span.add("attempts")
+        return asyncio.wait_for(
+            async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+            ),
+            timeout
+        )
+
+    span.set("tokens_in", estimate_tokens(question + response_content))
+    estimated_tokens = estimate_tokens(question + response_content) + REWARD_OUTPUT_TOKENS
+    queued = time.perf_counter()
+    await semaphore.acquire(estimated_tokens)
+    try:
+        span.set("queue_seconds", time.perf_counter() - queued)
+        response = await rate_limiter.call(request, estimated_tokens)
+    finally:
+        semaphore.release()
+
+    scores = get_scores_from_response(response)
+    response_cache.set(cache_key, scores)
+    return scores
+
+# Function to get scores from response
+def get_scores_from_response(openai_response_template):
+    logprobs = openai_response_template.choices[0].logprobs.content
+    score_dict = {}
+    for score in logprobs:
+        score_dict[score.token] = score.logprob
+    return score_dict
+
+# Function to get the question and both responses from a question-response card
+def get_question_response_pair(question_response_card):
+    content = question_response_card["question_response"]["render"][0]["content"]
+    return content["question"], content["responses"]["response_a"], content["responses"]["response_b"]
+
+# Function to build a processed question-response card pair.
+# score_a/score_b keep the helpfulness score, scores_a/scores_b hold every reward attribute.
+def build_scored_pair(question, response_a, scores_a, response_b, scores_b):
+    return {
+        "question": question,
+        "response_a": response_a,
+        "score_a": scores_a["helpfulness"],
+        "scores_a": scores_a,
+        "response_b": response_b,
+        "score_b": scores_b["helpfulness"],
+        "scores_b": scores_b
+    }
+
+# Function to process the question-response card pairs
+def process_question_response_card_pairs(question_response_cards):
+    # Initialize a list to store the processed question-response card pairs
+    processed_question_response_card_pairs = []
+
+    # Iterate over the question-response cards
+    for question_response_card in question_response_cards:
+        # Get the question and responses from the question-response card
+        question, response_a, response_b = get_question_response_pair(question_response_card)
+
+        # Get the scores for the responses using the Nvidia reward model
+        scores_a = get_response_and_scores(get_client(), REWARD_MODEL, question, response_a)
+        scores_b = get_response_and_scores(get_client(), REWARD_MODEL, question, response_b)
+
+        # Add the processed question-response card pair to the list
+        processed_question_response_card_pairs.append(
+            build_scored_pair(question, response_a, scores_a, response_b, scores_b)
+        )
+
+    # Return the list of processed question-response card pairs
+    return processed_question_response_card_pairs
+
+# Function to process the question-response card pairs with every reward call in flight at once.
+# Pass a shared semaphore to bound the reward calls together with other model calls.
+async def process_question_response_card_pairs_async(question_response_cards, semaphore=None, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT):
+    if semaphore is None:
+        semaphore = rate_limiter.create_semaphore(max_concurrency)
+
+    pairs = [get_question_response_pair(card) for card in question_response_cards]
+    scores = await gather_or_cancel([
+        get_response_and_scores_async(get_async_client(), REWARD_MODEL, question, response, semaphore, timeout)
+        for question, response_a, response_b in pairs
+        for response in (response_a, response_b)
+    ])
+
+    return [
+        build_scored_pair(question, response_a, scores[2 * i], response_b, scores[2 * i + 1])
+        for i, (question, response_a, response_b) in enumerate(pairs)
+    ]
+
+# Function to process the question-response cards of many subjects in one scoring batch.
+# Returns one list of processed pairs per input batch, in the same order.
+async def process_question_response_card_batches_async(question_response_card_batches, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT):
+    question_response_cards = [card for batch in question_response_card_batches for card in batch]
+    processed_pairs = await process_question_response_card_pairs_async(
+        question_response_cards, max_concurrency=max_concurrency, timeout=timeout
+    )
+
+    processed_batches = []
+    start = 0
+    for batch in question_response_card_batches:
+        processed_batches.append(processed_pairs[start:start + len(batch)])
+        start += len(batch)
+    return processed_batches
+
+# Function to build the card ID prefix for a subtopic
+def get_card_prefix(subject, subtopic):
+    return f"{subject['topic']}-{subtopic['name']}"
+
+# Function to get the values bound to the placeholders of a card prompt
+def get_prompt_values(subject, subtopic, content_type):
+    return {
+        "max_objects": MAX_OBJECTS[content_type],
+        "content_type": content_type,
+        "subtopic": subtopic["name"],
+        "skill_name": subject["skill_name"],
+        "topic": subject["topic"],
+        "card_prefix": get_card_prefix(subject, subtopic),
+        "concept": subtopic["name"],
+        "programming_concept": subtopic["name"],
+        "programming_language": subtopic.get("language", subject.get("language", DEFAULT_PROGRAMMING_LANGUAGE)),
+        "schema": CARD_SCHEMA_TEXTS[content_type]
+    }
+
+# Function to get the name of the card template of a content type in the current output mode
+def get_card_template_name(content_type):
+    return f"structured:{content_type}" if structured_output else content_type
+
+# Function to render the combined TEXT_PROMPT and AI_PROMPTS card prompt
+def build_prompt(subject, subtopic, content_type):
+    return prompt_templates.render(get_card_template_name(content_type), **get_prompt_values(subject, subtopic, content_type))
+
+# Function to get the stable fingerprint of a card prompt, for caching and deduplication
+def get_prompt_fingerprint(subject, subtopic, content_type):
+    return prompt_templates.fingerprint(get_card_template_name(content_type), **get_prompt_values(subject, subtopic, content_type))
+
+# Function to wrap generated content into the card object for its content type
+def build_card(card_prefix, subtopic, content_type, content):
+    element, about = CARD_RENDER[content_type]
+    return {
+        content_type: {
+            "cardId": f"{card_prefix}_{content_type}",
+            "render": [
+                {"element": element, "about": about.format(name=subtopic["name"]), "content": content}
+            ]
+        }
+    }
+
+# Function to get the number of quiz questions of a subtopic
+def get_quiz_question_count(subject, subtopic):
+    return int(subtopic.get("n_questions", subject.get("n_questions", QUIZ_QUESTIONS)))
+
+# Function to get the completion budget of a batched quiz call
+def get_quiz_max_tokens(n_questions):
+    return min(FUSED_MAX_TOKENS, max(GENERATION_PARAMS["max_tokens"], n_questions * QUIZ_ITEM_MAX_TOKENS))
+
+# Function to get the completion budget of a fused call: one per-type budget per content type, capped
+def get_fused_max_tokens(content_types):
+    return min(FUSED_MAX_TOKENS, GENERATION_PARAMS["max_tokens"] * len(content_types))
+
+# Function to render the fused prompt of a subtopic's content types, returning it with its schema
+def build_fused_prompt(subject, subtopic, content_types):
+    n_questions = get_quiz_question_count(subject, subtopic)
+    schema = get_fused_schema({content_type: MAX_OBJECTS[content_type] for content_type in content_types}, n_questions)
+    values = dict(get_prompt_values(subject, subtopic, content_types[0]), n_questions=n_questions)
+    sections = "\n".join(
+        prompt_templates.render(f"section:{content_type}", **dict(values, content_type=content_type, max_objects=MAX_OBJECTS[content_type]))
+        for content_type in content_types
+    )
+    return prompt_templates.render(FUSED_CONTENT_TYPE, **dict(values, sections=sections, schema=dump_schema(schema))), schema
+
+# Function to split quiz items of a fused answer into the questions and their (response_a, response_b) pairs
+def split_quiz_items(quiz_items):
+    return [item["question"] for item in quiz_items], [(item["response_a"], item["response_b"]) for item in quiz_items]
+
+# Function to wrap validated card objects into the card object for their content type, one render entry each
+def build_structured_card(card_prefix, subtopic, content_type, card_objects):
+    element, about = CARD_RENDER[content_type]
+    return {
+        content_type: {
+            "cardId": f"{card_prefix}_{content_type}",
+            "render": [
+                {"element": element, "about": about.format(name=subtopic["name"]), "content": card_object["content"]}
+                for card_object in card_objects
+            ]
+        }
+    }
+
+# Function to build the prompt repairing a structured answer that failed validation
+def build_repair_prompt(prompt, response, error):
+    return prompt_templates.render("repair", prompt=prompt, response=response, errors="; ".join(error.errors))
+
+# Function to get a structured answer and parse it against its schema. An answer that fails
+# validation is dropped from the cache and repaired with a prompt quoting the problems, so
+# only this call is retried instead of the whole subtopic. The repaired answer is cached
+# under the original prompt, so a rerun does not pay for the original or the repair call again.
+def get_structured_response(prompt, schema, allow_empty=False):
+    original_prompt = prompt
+    response = get_openai_response(prompt, is_json_complete)
+    for attempt in range(MAX_REPAIR_ATTEMPTS + 1):
+        try:
+            parsed = parse_structured(response, schema, allow_empty)
+        except SchemaValidationError as error:
+            response_cache.delete(get_completion_cache_key(prompt))
+            if attempt == MAX_REPAIR_ATTEMPTS:
+                raise
+            with tracer.span("repair", errors=len(error.errors)):
+                prompt = build_repair_prompt(prompt, response, error)
+                response = get_openai_response(prompt, is_json_complete)
+        else:
+            if attempt:
+                response_cache.set(get_completion_cache_key(original_prompt), response)
+            return parsed
+
+# Function to get a structured answer with the async client, repairing it on its own when it fails validation
+async def get_structured_response_async(prompt, schema, semaphore, timeout=REQUEST_TIMEOUT, allow_empty=False):
+    original_prompt = prompt
+    response = await get_openai_response_async(prompt, semaphore, timeout, is_json_complete)
+    for attempt in range(MAX_REPAIR_ATTEMPTS + 1):
+        try:
+            parsed = parse_structured(response, schema, allow_empty)
+        except SchemaValidationError as error:
+            response_cache.delete(get_completion_cache_key(prompt))
+            if attempt == MAX_REPAIR_ATTEMPTS:
+                raise
+            with tracer.span("repair", errors=len(error.errors)):
+                prompt = build_repair_prompt(prompt, response, error)
+                response = await get_openai_response_async(prompt, semaphore, timeout, is_json_complete)
+        else:
+            if attempt:
+                response_cache.set(get_completion_cache_key(original_prompt), response)
+            return parsed
+
+# Function to split the question list returned by the model
+def parse_questions(question_response):
+    return [question.strip() for question in question_response.split("\n") if question]
+
+# Function to split a RESPONSE A / RESPONSE B answer into its two responses
+def parse_response_pair(response_set):
+    response_a = response_set.split("RESPONSE B:")[0].replace("RESPONSE A:", "").strip()
+    response_b = response_set.split("RESPONSE B:")[-1].split("\n\n")[0].strip()
+    return response_a, response_b
+
+# Function to build the quiz card followed by its question-response cards
+def build_quiz_cards(card_prefix, subtopic, quiz_content):
+    question_response_cards = []
+    for i, question_response in enumerate(quiz_content):
+        question_response_cards.append({
+            "question_response": {
+                "cardId": f"{card_prefix}_question_response_{i+1}",
+                "render": [
+                    {"element": "question_response", "about": f"Question-response card {i+1} for {subtopic['name']}", "content": question_response}
+                ]
+            }
+        })
+    return build_card(card_prefix, subtopic, "quiz", quiz_content), question_response_cards
+
+# Function to attach the processed scores to the question-response cards.
+# score keeps the helpfulness of each response and reward every reward attribute.
+def attach_question_response_scores(question_response_cards, question_response_score_list):
+    # Add the scores to the question-response cards and print them
+    for i, question_response in enumerate(question_response_score_list):
+        render = question_response_cards[i]["question_response"]["render"][0]
+        render["score"] = {
+            "response_a": question_response["score_a"],
+            "response_b": question_response["score_b"]
+        }
+        render["reward"] = {
+            "response_a": question_response["scores_a"],
+            "response_b": question_response["scores_b"]
+        }
+        # Print the card responses with scores
+        print(f"Question: {question_response['question']}")
+        print(f"Response A: {question_response['response_a']} (Score: {question_response['score_a']})")
+        print(f"Response B: {question_response['response_b']} (Score: {question_response['score_b']})\n")
+
+# Function to score the question-response cards and attach the scores to them
+def score_question_response_cards(question_response_cards):
+    question_response_score_list = process_question_response_card_pairs(question_response_cards)
+    attach_question_response_scores(question_response_cards, question_response_score_list)
+
+# Function to score the question-response cards concurrently and attach the scores to them
+async def score_question_response_cards_async(question_response_cards, semaphore, timeout=REQUEST_TIMEOUT):
+    question_response_score_list = await process_question_response_card_pairs_async(
+        question_response_cards, semaphore=semaphore, timeout=timeout
+    )
+    attach_question_response_scores(question_response_cards, question_response_score_list)
+
+# Function to list the content types requested by a subtopic, in AI_PROMPTS order
+def get_subtopic_content_types(subtopic):
+    return [content_type for content_type in AI_PROMPTS.keys() if content_type in subtopic]
+
+# Function to list the (subtopic, content_type) units of a subject in subtopic_array order.
+# In fused mode each subtopic is one (subtopic, FUSED_CONTENT_TYPE) unit.
+def iter_generation_units(subject):
+    for subtopic in subject["subtopics"]:
+        content_types = get_subtopic_content_types(subtopic)
+        if fused_output and content_types:
+            yield subtopic, FUSED_CONTENT_TYPE
+            continue
+        for content_type in content_types:
+            yield subtopic, content_type
+
+# Function to estimate the number of tokens in a text
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# Function to describe one stage of model calls in a generation plan
+def plan_step(stage, model, calls, input_tokens_per_call, output_tokens_per_call):
+    return {
+        "stage": stage,
+        "model": model,
+        "calls": calls,
+        "input_tokens": calls * input_tokens_per_call,
+        "output_tokens": calls * output_tokens_per_call
+    }
+
+# Function to declare the model calls needed to build the cards of one content type
+def plan_card_calls(subject, subtopic, content_type):
+    max_tokens = GENERATION_PARAMS["max_tokens"]
+    if content_type == FUSED_CONTENT_TYPE:
+        # One call for every content type, plus the reward calls of the quiz responses
+        content_types = get_subtopic_content_types(subtopic)
+        prompt, _ = build_fused_prompt(subject, subtopic, content_types)
+        steps = [plan_step("fused", GENERATION_MODEL, 1, estimate_tokens(prompt), get_fused_max_tokens(content_types))]
+        if "quiz" in content_types:
+            score_tokens = ESTIMATED_QUESTION_TOKENS + ESTIMATED_RESPONSE_TOKENS
+            n_questions = get_quiz_question_count(subject, subtopic)
+            steps.append(plan_step("scores", REWARD_MODEL, 2 * n_questions, score_tokens, REWARD_OUTPUT_TOKENS))
+        return steps
+    if content_type == "quiz":
+        n_questions = get_quiz_question_count(subject, subtopic)
+        score_tokens = ESTIMATED_QUESTION_TOKENS + ESTIMATED_RESPONSE_TOKENS
+        score_step = plan_step("scores", REWARD_MODEL, 2 * n_questions, score_tokens, REWARD_OUTPUT_TOKENS)
+        if structured_output:
+            # One call for every question with its responses, one per response for its score
+            quiz_prompt = build_quiz_batch_prompt(subtopic, n_questions)
+            return [plan_step("quiz", GENERATION_MODEL, 1, estimate_tokens(quiz_prompt), get_quiz_max_tokens(n_questions)), score_step]
+        # One call for the questions, one per question for its responses, one per response for its score
+        question_prompt = prompt_templates.render("question", sub_topic=subtopic["name"], n_questions=n_questions)
+        response_prompt_tokens = estimate_tokens(RESPONSE_PROMPT_TEMPLATE) + ESTIMATED_QUESTION_TOKENS
+        return [
+            plan_step("questions", GENERATION_MODEL, 1, estimate_tokens(question_prompt), max_tokens),
+            plan_step("responses", GENERATION_MODEL, n_questions, response_prompt_tokens, max_tokens),
+            score_step
+        ]
+    prompt = build_prompt(subject, subtopic, content_type)
+    steps = [plan_step("card", GENERATION_MODEL, 1, estimate_tokens(prompt), max_tokens)]
+    if quality_threshold is not None:
+        # One reward call per card object of the first candidate; regenerated or hedged candidates repeat both steps
+        score_calls = MAX_OBJECTS[content_type] if structured_output else 1
+        steps.append(plan_step("quality", REWARD_MODEL, score_calls, ESTIMATED_RESPONSE_TOKENS, REWARD_OUTPUT_TOKENS))
+    return steps
+
+# Function to build the generation plan of a subject, one entry per (subtopic, content_type) unit
+def build_generation_plan(subject):
+    return [
+        {
+            "cardId": f"{get_card_prefix(subject, subtopic)}_{content_type}",
+            "content_type": content_type,
+            "steps": plan_card_calls(subject, subtopic, content_type)
+        }
+        for subtopic, content_type in iter_generation_units(subject)
+    ]
+
+# Function to total the planned calls and token budget per model
+def summarize_generation_plan(plan):
+    summary = {}
+    for unit in plan:
+        for step in unit["steps"]:
+            totals = summary.setdefault(step["model"], {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+            totals["calls"] += step["calls"]
+            totals["input_tokens"] += step["input_tokens"]
+            totals["output_tokens"] += step["output_tokens"]
+    return summary
+
+# Function to print the planned call count and estimated token budget of a generation plan
+def print_generation_plan(plan):
+    for unit in plan:
+        stages = ", ".join(f"{step['calls']} x {step['stage']}" for step in unit["steps"])
+        print(f"{unit['cardId']}: {stages}")
+    summary = summarize_generation_plan(plan)
+    for model, totals in summary.items():
+        print(f"{model}: {totals['calls']} calls, ~{totals['input_tokens']} input tokens, <= {totals['output_tokens']} output tokens")
+    print(f"Total: {sum(totals['calls'] for totals in summary.values())} calls")
+
+# Function to build the quiz content from the questions and their (response_a, response_b) pairs
+def build_quiz_content(questions, response_pairs):
+    quiz_content = []
+    for question, (response_a, response_b) in zip(questions, response_pairs):
+        quiz_content.append({
+            "question": question,
+            "responses": {
+                "response_a": response_a,
+                "response_b": response_b
+            }
+        })
+    return quiz_content
+
+# Function to render the prompt of a batched quiz call
+def build_quiz_batch_prompt(subtopic, n_questions):
+    return prompt_templates.render("quiz_batch", sub_topic=subtopic["name"], n_questions=n_questions, schema=dump_schema(get_quiz_schema(n_questions)))
+
+# Function to parse a batched quiz answer into quiz content, or None when it fails validation.
+# A failed answer is dropped from the cache, so a rerun asks prompt again instead of falling back.
+def parse_quiz_batch(response, prompt, n_questions):
+    try:
+        answer = parse_structured(response, get_quiz_schema(n_questions))
+    except SchemaValidationError:
+        response_cache.delete(get_completion_cache_key(prompt, get_quiz_max_tokens(n_questions)))
+        tracer.current().set("fallback", True)
+        return None
+    return build_quiz_content(*split_quiz_items(answer["quiz"]))
+
+# Function to generate the questions of a quiz
+def generate_questions(subtopic, n_questions=QUIZ_QUESTIONS):
+    if structured_output:
+        question_prompt = prompt_templates.render(
+            "question_json", sub_topic=subtopic["name"], n_questions=n_questions, schema=dump_schema(get_question_schema(n_questions))
+        )
+        return get_structured_response(question_prompt, get_question_schema(n_questions))["questions"]
+    question_prompt = prompt_templates.render("question", sub_topic=subtopic["name"], n_questions=n_questions)
+    return parse_questions(get_openai_response(question_prompt))
+
+# Function to generate the (response_a, response_b) pair of a quiz question
+def generate_response_pair(question):
+    if structured_output:
+        response_prompt = prompt_templates.render("response_json", question=question, schema=dump_schema(RESPONSE_PAIR_SCHEMA))
+        response_pair = get_structured_response(response_prompt, RESPONSE_PAIR_SCHEMA)
+        return response_pair["response_a"], response_pair["response_b"]
+    return parse_response_pair(get_openai_response(prompt_templates.render("response", question=question), is_response_b_complete))
+
+# Function to generate the quiz content of a subtopic with one call per question, all in flight at once
+def generate_quiz_content(subtopic, n_questions):
+    # Generate questions for the subtopic
+    with tracer.span("quiz:questions"):
+        questions = generate_questions(subtopic, n_questions)
+
+    # Generate responses for each question on a thread per question
+    with tracer.span("quiz:responses"):
+        with ThreadPoolExecutor(max(1, min(len(questions), MAX_CONCURRENT_REQUESTS))) as executor:
+            response_pairs = list(executor.map(generate_response_pair, questions))
+    return build_quiz_content(questions, response_pairs)
+
+# Function to generate the quiz cards of one subtopic. In structured mode every question and
+# its responses come from one batched call, falling back to a call per question when the
+# batched answer fails validation.
+def generate_quiz_cards(subject, subtopic):
+    card_prefix = get_card_prefix(subject, subtopic)
+    n_questions = get_quiz_question_count(subject, subtopic)
+    quiz_content = None
+    if structured_output:
+        with tracer.span("quiz:batch", n_questions=n_questions):
+            prompt = build_quiz_batch_prompt(subtopic, n_questions)
+            response = get_openai_response(prompt, is_json_complete, max_tokens=get_quiz_max_tokens(n_questions))
+            quiz_content = parse_quiz_batch(response, prompt, n_questions)
+    if quiz_content is None:
+        quiz_content = generate_quiz_content(subtopic, n_questions)
+    with tracer.span("quiz:parse"):
+        quiz_card, question_response_cards = build_quiz_cards(card_prefix, subtopic, quiz_content)
+
+    # Score the responses of the question-response cards
+    with tracer.span("quiz:score"):
+        score_question_response_cards(question_response_cards)
+    return [quiz_card] + question_response_cards
+
+# Function to generate every requested content type of a subtopic with one structured call.
+# A content type whose part of the answer is missing or invalid falls back to its own call.
+def generate_fused_cards(subject, subtopic):
+    card_prefix = get_card_prefix(subject, subtopic)
+    content_types = get_subtopic_content_types(subtopic)
+    with tracer.span("prompt_build"):
+        prompt, schema = build_fused_prompt(subject, subtopic, content_types)
+    parts = parse_fused(get_openai_response(prompt, is_json_complete, max_tokens=get_fused_max_tokens(content_types)), schema)
+    tracer.current().set("fallbacks", len(content_types) - len(parts))
+
+    cards = []
+    for content_type in content_types:
+        if content_type not in parts:
+            cards.extend(generate_cards(subject, subtopic, content_type))
+        elif content_type == "quiz":
+            quiz_card, question_response_cards = build_quiz_cards(card_prefix, subtopic, build_quiz_content(*split_quiz_items(parts["quiz"])))
+            with tracer.span("quiz:score"):
+                score_question_response_cards(question_response_cards)
+            cards.extend([quiz_card] + question_response_cards)
+        else:
+            cards.append(build_structured_card(card_prefix, subtopic, content_type, parts[content_type]))
+    return cards
+
+# Function to generate the cards of one (subtopic, content_type) unit
+def generate_cards(subject, subtopic, content_type):
+    with tracer.span(f"card:{content_type}", subtopic=subtopic["name"]):
+        if content_type == FUSED_CONTENT_TYPE:
+            return generate_fused_cards(subject, subtopic)
+        if content_type == "quiz":
+            return generate_quiz_cards(subject, subtopic)
+        if quality_threshold is not None:
+            return generate_gated_cards(subject, subtopic, content_type)
+        return generate_text_cards(subject, subtopic, content_type)
+
+# Function to generate the cards of a text content type
+def generate_text_cards(subject, subtopic, content_type):
+    with tracer.span("prompt_build"):
+        prompt = build_prompt(subject, subtopic, content_type)
+    if structured_output:
+        answer = get_structured_response(prompt, CARD_SCHEMAS[content_type], allow_empty=True)
+        return [build_structured_card(get_card_prefix(subject, subtopic), subtopic, content_type, answer.get("cards", []))]
+    response = get_openai_response(prompt, is_empty_json_object)
+    return [build_card(get_card_prefix(subject, subtopic), subtopic, content_type, response)]
+
+# Function to get the render entries of cards, which the quality gate scores one by one.
+# The empty JSON answer of a content type irrelevant for the subtopic is left out.
+def get_render_entries(cards):
+    return [
+        entry for card in cards for value in card.values() for entry in value["render"]
+        if not (isinstance(entry["content"], str) and is_empty_json_text(entry["content"]))
+    ]
+
+# Function to attach each entry's reward scores to it and return the mean helpfulness, None without entries
+def attach_render_rewards(entries, entry_scores):
+    for entry, scores in zip(entries, entry_scores):
+        entry["reward"] = scores
+    return sum(scores["helpfulness"] for scores in entry_scores) / len(entry_scores) if entry_scores else None
+
+# Function to tell whether a candidate's quality passes the gate; a card without render
+# entries to score (the content type is irrelevant for the subtopic) passes
+def is_quality_accepted(quality):
+    return quality is None or quality >= quality_threshold
+
+# Function to generate and score one candidate of a text card, returning (cards, quality)
+def generate_card_candidate(subject, subtopic, content_type, candidate):
+    token = generation_candidate.set(candidate)
+    timing = CandidateTiming()
+    timing_token = candidate_timing.set(timing)
+    try:
+        with tracer.span("quality:candidate", candidate=candidate) as span:
+            cards = generate_text_cards(subject, subtopic, content_type)
+            record_candidate_generated(timing)
+            entries = get_render_entries(cards)
+            quality = attach_render_rewards(entries, [
+                get_response_and_scores(get_client(), REWARD_MODEL, entry["about"], str(entry["content"])) for entry in entries
+            ])
+            span.set("quality", quality)
+    finally:
+        generation_candidate.reset(token)
+        candidate_timing.reset(timing_token)
+    return cards, quality
+
+# Function to mark a candidate as generated, measuring its time at the endpoint when a call was sent
+def record_candidate_generated(timing):
+    timing.generated = True
+    if timing.requests:
+        candidate_latencies.append(timing.endpoint_seconds)
+
+# Function to generate a text card through the quality gate one candidate at a time,
+# keeping the best scored candidate when none passes
+def generate_gated_cards(subject, subtopic, content_type):
+    with tracer.span("quality_gate") as span:
+        best = None
+        for candidate in range(QUALITY_MAX_CANDIDATES):
+            cards, quality = generate_card_candidate(subject, subtopic, content_type, candidate)
+            span.set("candidates", candidate + 1)
+            if is_quality_accepted(quality):
+                span.set("accepted", True)
+                return cards
+            if best is None or quality > best[1]:
+                best = (cards, quality)
+        span.set("accepted", False)
+        return best[0]
+
+# Function to generate array of subtopic objects with content.
+# With dry_run the generation plan is printed and no model call is sent.
+def generate_subtopic_array(subject, dry_run=False):
+    if dry_run:
+        print_generation_plan(build_generation_plan(subject))
+        return []
+    return list(iter_subtopic_cards(subject))
+
+# Function to yield the subtopic cards one by one as they are generated
+def iter_subtopic_cards(subject):
+    for subtopic, content_type in iter_generation_units(subject):
+        yield from generate_cards(subject, subtopic, content_type)
+
+# Function to generate the questions of a quiz with the async client
+async def generate_questions_async(subtopic, semaphore, timeout, n_questions=QUIZ_QUESTIONS):
+    if structured_output:
+        question_prompt = prompt_templates.render(
+            "question_json", sub_topic=subtopic["name"], n_questions=n_questions, schema=dump_schema(get_question_schema(n_questions))
+        )
+        answer = await get_structured_response_async(question_prompt, get_question_schema(n_questions), semaphore, timeout)
+        return answer["questions"]
+    question_prompt = prompt_templates.render("question", sub_topic=subtopic["name"], n_questions=n_questions)
+    return parse_questions(await get_openai_response_async(question_prompt, semaphore, timeout))
+
+# Function to generate the (response_a, response_b) pair of a quiz question with the async client
+async def generate_response_pair_async(question, semaphore, timeout):
+    if structured_output:
+        response_prompt = prompt_templates.render("response_json", question=question, schema=dump_schema(RESPONSE_PAIR_SCHEMA))
+        response_pair = await get_structured_response_async(response_prompt, RESPONSE_PAIR_SCHEMA, semaphore, timeout)
+        return response_pair["response_a"], response_pair["response_b"]
+    response_prompt = prompt_templates.render("response", question=question)
+    return parse_response_pair(await get_openai_response_async(response_prompt, semaphore, timeout, is_response_b_complete))
+
+# Function to generate the quiz content of a subtopic with one call per question, all in flight at once
+async def generate_quiz_content_async(subtopic, n_questions, semaphore, timeout):
+    with tracer.span("quiz:questions"):
+        questions = await generate_questions_async(subtopic, semaphore, timeout, n_questions)
+
+    # Generate the responses for every question at once
+    with tracer.span("quiz:responses"):
+        response_pairs = await gather_or_cancel([
+            generate_response_pair_async(question, semaphore, timeout) for question in questions
+        ])
+    return build_quiz_content(questions, response_pairs)
+
+# Function to generate the quiz cards of one subtopic, batched in structured mode like generate_quiz_cards
+async def generate_quiz_cards_async(subject, subtopic, semaphore, timeout):
+    card_prefix = get_card_prefix(subject, subtopic)
+    n_questions = get_quiz_question_count(subject, subtopic)
+    quiz_content = None
+    if structured_output:
+        with tracer.span("quiz:batch", n_questions=n_questions):
+            prompt = build_quiz_batch_prompt(subtopic, n_questions)
+            response = await get_openai_response_async(
+                prompt, semaphore, timeout, is_json_complete, max_tokens=get_quiz_max_tokens(n_questions)
+            )
+            quiz_content = parse_quiz_batch(response, prompt, n_questions)
+    if quiz_content is None:
+        quiz_content = await generate_quiz_content_async(subtopic, n_questions, semaphore, timeout)
+    with tracer.span("quiz:parse"):
+        quiz_card, question_response_cards = build_quiz_cards(card_prefix, subtopic, quiz_content)
+
+    with tracer.span("quiz:score"):
+        await score_question_response_cards_async(question_response_cards, semaphore, timeout)
+    return [quiz_card] + question_response_cards
+
+# Function to finish one content type of a fused answer: its own call when the part is missing,
+# scoring for the quiz, or the card object as it is
+async def finish_fused_part_async(subject, subtopic, content_type, parts, semaphore, timeout):
+    card_prefix = get_card_prefix(subject, subtopic)
+    if content_type not in parts:
+        return await generate_cards_async(subject, subtopic, content_type, semaphore, timeout)
+    if content_type == "quiz":
+        quiz_card, question_response_cards = build_quiz_cards(card_prefix, subtopic, build_quiz_content(*split_quiz_items(parts["quiz"])))
+        with tracer.span("quiz:score"):
+            await score_question_response_cards_async(question_response_cards, semaphore, timeout)
+        return [quiz_card] + question_response_cards
+    return [build_structured_card(card_prefix, subtopic, content_type, parts[content_type])]
+
+# Function to generate every requested content type of a subtopic with one structured call.
+# Fallback calls and quiz scoring run concurrently; cards keep the per-type order.
+async def generate_fused_cards_async(subject, subtopic, semaphore, timeout):
+    content_types = get_subtopic_content_types(subtopic)
+    with tracer.span("prompt_build"):
+        prompt, schema = build_fused_prompt(subject, subtopic, content_types)
+    response = await get_openai_response_async(
+        prompt, semaphore, timeout, is_json_complete, max_tokens=get_fused_max_tokens(content_types)
+    )
+    parts = parse_fused(response, schema)
+    tracer.current().set("fallbacks", len(content_types) - len(parts))
+
+    results = await gather_or_cancel([
+        finish_fused_part_async(subject, subtopic, content_type, parts, semaphore, timeout)
+        for content_type in content_types
+    ])
+    return [card for cards in results for card in cards]
+
+# Function to generate the cards of one (subtopic, content_type) unit
+async def generate_cards_async(subject, subtopic, content_type, semaphore, timeout):
+    with tracer.span(f"card:{content_type}", subtopic=subtopic["name"]):
+        if content_type == FUSED_CONTENT_TYPE:
+            return await generate_fused_cards_async(subject, subtopic, semaphore, timeout)
+        if content_type == "quiz":
+            return await generate_quiz_cards_async(subject, subtopic, semaphore, timeout)
+        if quality_threshold is not None:
+            return await generate_gated_cards_async(subject, subtopic, content_type, semaphore, timeout)
+        return await generate_text_cards_async(subject, subtopic, content_type, semaphore, timeout)
+
+# Function to generate the cards of a text content type with the async client
+async def generate_text_cards_async(subject, subtopic, content_type, semaphore, timeout):
+    with tracer.span("prompt_build"):
+        prompt = build_prompt(subject, subtopic, content_type)
+    if structured_output:
+        answer = await get_structured_response_async(prompt, CARD_SCHEMAS[content_type], semaphore, timeout, allow_empty=True)
+        return [build_structured_card(get_card_prefix(subject, subtopic), subtopic, content_type, answer.get("cards", []))]
+    response = await get_openai_response_async(prompt, semaphore, timeout, is_empty_json_object)
+    return [build_card(get_card_prefix(subject, subtopic), subtopic, content_type, response)]
+
+# Function to generate and score one candidate of a text card with the async client, returning (cards, quality).
+# It runs as its own task, so the candidate number and timing stay with its calls.
+async def generate_card_candidate_async(subject, subtopic, content_type, semaphore, timeout, candidate, timing):
+    generation_candidate.set(candidate)
+    candidate_timing.set(timing)
+    with tracer.span("quality:candidate", candidate=candidate) as span:
+        cards = await generate_text_cards_async(subject, subtopic, content_type, semaphore, timeout)
+        record_candidate_generated(timing)
+        entries = get_render_entries(cards)
+        quality = attach_render_rewards(entries, await gather_or_cancel([
+            get_response_and_scores_async(get_async_client(), REWARD_MODEL, entry["about"], str(entry["content"]), semaphore, timeout)
+            for entry in entries
+        ]))
+        span.set("quality", quality)
+    return cards, quality
+
+# Function to get how long a candidate may spend at the endpoint before it is hedged, None until enough candidates were measured
+def get_hedge_delay():
+    if len(candidate_latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return percentile(candidate_latencies, HEDGE_PERCENTILE)
+
+# Function to generate a text card through the quality gate. Each candidate is scored as soon
+# as it is generated, and one below the threshold starts another candidate. The newest candidate,
+# once it has spent the recent p95 generation time at the endpoint without finishing its
+# generation, is hedged with a second one running beside it; time queued for a slot does not count.
+# The first passing candidate wins and the others are cancelled; when the candidates run out,
+# the best scored one is kept. At most QUALITY_MAX_CANDIDATES are generated per card.
+async def generate_gated_cards_async(subject, subtopic, content_type, semaphore, timeout):
+    with tracer.span("quality_gate") as span:
+        pending = set()
+        launched = 0
+        timing = None
+        best = None
+        error = None
+
+        def launch():
+            nonlocal launched, timing
+            timing = CandidateTiming()
+            pending.add(asyncio.ensure_future(
+                generate_card_candidate_async(subject, subtopic, content_type, semaphore, timeout, launched, timing)
+            ))
+            launched += 1
+            span.set("candidates", launched)
+
+        launch()
+        try:
+            while pending:
+                hedge_delay = get_hedge_delay() if launched < QUALITY_MAX_CANDIDATES and not timing.generated else None
+                # A candidate not yet at the endpoint cannot be due sooner than this, so the wait is checked again
+                wait = max(0.0, hedge_delay - timing.get_endpoint_seconds()) if hedge_delay is not None else None
+                done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if not timing.generated and timing.get_endpoint_seconds() >= hedge_delay:
+                        span.add("hedges")
+                        launch()
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    try:
+                        cards, quality = task.result()
+                    except Exception as candidate_error:
+                        error = candidate_error
+                    else:
+                        if is_quality_accepted(quality):
+                            span.set("accepted", True)
+                            return cards
+                        if best is None or quality > best[1]:
+                            best = (cards, quality)
+                    if launched < QUALITY_MAX_CANDIDATES:
+                        launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        span.set("accepted", False)
+        if best is None:
+            raise error
+        return best[0]
+
+# Function to generate the subtopic array with every model call fanned out at once.
+# The returned cards keep the same order as generate_subtopic_array.
+# With dry_run the generation plan is printed and no model call is sent.
+# Pass a shared semaphore to bound the calls together with other model calls.
+async def generate_subtopic_array_async(subject, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT, dry_run=False, semaphore=None):
+    if dry_run:
+        print_generation_plan(build_generation_plan(subject))
+        return []
+
+    if semaphore is None:
+        semaphore = rate_limiter.create_semaphore(max_concurrency)
+    results = await gather_or_cancel([
+        generate_cards_async(subject, subtopic, content_type, semaphore, timeout)
+        for subtopic, content_type in iter_generation_units(subject)
+    ])
+
+    subtopic_array = []
+    for cards in results:
+        subtopic_array.extend(cards)
+    return subtopic_array
+
+# Function to yield the subtopic cards as soon as each one is ready.
+# Units are scheduled lazily so at most max_concurrency are in flight at once,
+# which keeps time-to-first-card and memory independent of the subject size.
+# Cards arrive in completion order, not in subtopic_array order.
+async def iter_subtopic_cards_async(subject, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT):
+    semaphore = rate_limiter.create_semaphore(max_concurrency)
+    async for task in iter_as_completed_async(
+        (
+            generate_cards_async(subject, subtopic, content_type, semaphore, timeout)
+            for subtopic, content_type in iter_generation_units(subject)
+        ),
+        max_concurrency
+    ):
+        for card in task.result():
+            yield card
+
+# Function to run coroutines from a lazy iterator with at most max_in_flight scheduled at once.
+# Each task is yielded as soon as it finishes; unfinished tasks are cancelled on exit.
+async def iter_as_completed_async(coroutines, max_in_flight):
+    coroutines = iter(coroutines)
+    pending = set()
+    try:
+        while True:
+            for coroutine in coroutines:
+                pending.add(asyncio.ensure_future(coroutine))
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Function to write cards to a JSON Lines file as they arrive, one card per line
+def write_cards_jsonl(cards, path, mode="a"):
+    count = 0
+    with open(path, mode, encoding="utf-8") as sink:
+        for card in cards:
+            sink.write(json.dumps(card, ensure_ascii=False) + "\n")
+            sink.flush()
+            count += 1
+    return count
+
+# Function to write cards from an async iterator to a JSON Lines file as they arrive
+async def write_cards_jsonl_async(cards, path):
+    count = 0
+    with open(path, "a", encoding="utf-8") as sink:
+        async for card in cards:
+            sink.write(json.dumps(card, ensure_ascii=False) + "\n")
+            sink.flush()
+            count += 1
+    return count
+
+# Function to load subjects from a JSON file (one subject or a list) or a JSON Lines file
+def load_subjects(path):
+    with open(path, encoding="utf-8") as source:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in source if line.strip()]
+        subjects = json.load(source)
+    return subjects if isinstance(subjects, list) else [subjects]
+
+# Function to build the checkpoint key of a (subject, subtopic, content_type) unit
+def get_unit_key(subject, subtopic, content_type):
+    return json.dumps([subject["topic"], subject["skill_name"], subtopic["name"], content_type], ensure_ascii=False)
+
+# Function to get the prompts that decide a unit's cards, including those of its fallback calls
+def get_unit_prompts(subject, subtopic, content_type):
+    if content_type == FUSED_CONTENT_TYPE:
+        content_types = get_subtopic_content_types(subtopic)
+        prompt, _ = build_fused_prompt(subject, subtopic, content_types)
+        return [prompt] + [
+            unit_prompt for fallback_type in content_types for unit_prompt in get_unit_prompts(subject, subtopic, fallback_type)
+        ]
+    if content_type == "quiz":
+        n_questions = get_quiz_question_count(subject, subtopic)
+        if structured_output:
+            return [
+                build_quiz_batch_prompt(subtopic, n_questions),
+                prompt_templates.render(
+                    "question_json", sub_topic=subtopic["name"], n_questions=n_questions, schema=dump_schema(get_question_schema(n_questions))
+                ),
+                RESPONSE_JSON_PROMPT_TEMPLATE
+            ]
+        return [prompt_templates.render("question", sub_topic=subtopic["name"], n_questions=n_questions), RESPONSE_PROMPT_TEMPLATE]
+    return [build_prompt(subject, subtopic, content_type)]
+
+# Function to build the manifest entry of a unit: the model and parameters it is generated
+# with and a fingerprint of those and its prompts, which changes whenever its cards would
+def get_unit_manifest_entry(subject, subtopic, content_type):
+    entry = {"model": GENERATION_MODEL, "params": GENERATION_PARAMS}
+    if content_type in ("quiz", FUSED_CONTENT_TYPE) or quality_threshold is not None:
+        entry["reward_model"] = REWARD_MODEL
+    if content_type not in ("quiz", FUSED_CONTENT_TYPE) and quality_threshold is not None:
+        entry["quality_threshold"] = quality_threshold
+    inputs = dict(entry, prompts=get_unit_prompts(subject, subtopic, content_type))
+    return dict(entry, fingerprint=prompt_fingerprint(json.dumps(inputs, sort_keys=True, ensure_ascii=False)))
+
+# Function to tell whether a unit belongs to a (index, count) shard, spreading units by a hash of their key
+def is_shard_unit(unit_key, shard):
+    index, count = shard
+    return zlib.crc32(unit_key.encode("utf-8")) % count == index
+
+# Function to get the checkpoint file a shard appends its finished units to
+def get_shard_checkpoint_path(checkpoint_path, shard):
+    return f"{checkpoint_path}.shard-{shard[0]}-of-{shard[1]}"
+
+# Function to parse a --shard value such as 2/8 into a (index, count) shard
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}, got {index}")
+    return index, count
+
+# Function to get the manifest entries of every unit of the subjects, by unit key
+def get_unit_manifest_entries(subjects):
+    return {
+        get_unit_key(subject, subtopic, content_type): get_unit_manifest_entry(subject, subtopic, content_type)
+        for subject in subjects
+        for subtopic, content_type in iter_generation_units(subject)
+    }
+
+# Function to load the record of every unit already recorded in a checkpoint file.
+# A line cut short by a crash is ignored, so its unit is simply generated again.
+# With fingerprints (unit key -> fingerprint) only records generated from the
+# current inputs are kept, so a unit whose prompt, model or parameters changed
+# is generated again even if an older record of it exists.
+def load_checkpoint(path, fingerprints=None):
+    completed = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as checkpoint:
+        for line in checkpoint:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if fingerprints is None or record.get("fingerprint") == fingerprints.get(record["unit"]):
+                completed[record["unit"]] = record
+    return completed
+
+# Function to open a checkpoint file for appending. A line cut short by a crash is
+# ended first, so the first new record does not run on into it and get lost with it.
+def open_checkpoint(path):
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as checkpoint:
+            checkpoint.seek(-1, os.SEEK_END)
+            ends_with_newline = checkpoint.read(1) == b"\n"
+        if not ends_with_newline:
+            with open(path, "a", encoding="utf-8") as checkpoint:
+                checkpoint.write("\n")
+    return open(path, "a", encoding="utf-8")
+
+# Function to load a checkpoint file together with the checkpoint files of its shards
+def load_checkpoints(checkpoint_path, fingerprints=None):
+    completed = load_checkpoint(checkpoint_path, fingerprints)
+    for path in sorted(glob.glob(f"{glob.escape(checkpoint_path)}.shard-*")):
+        completed.update(load_checkpoint(path, fingerprints))
+    return completed
+
+# Function to write the cards of the completed units in subject, subtopic and content type order
+def write_curriculum_output(subjects, completed, output_path):
+    return write_cards_jsonl(
+        (
+            card
+            for subject in subjects
+            for subtopic, content_type in iter_generation_units(subject)
+            for card in completed.get(get_unit_key(subject, subtopic, content_type), {}).get("cards", [])
+        ),
+        output_path,
+        mode="w"
+    )
+
+# Function to get the manifest file written next to an output file
+def get_manifest_path(output_path):
+    return f"{output_path}.manifest"
+
+# Function to load a manifest (cardId -> unit key, fingerprint, model and parameters), empty when there is none
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as manifest:
+        return json.load(manifest)
+
+# Function to write the manifest of the completed units in output order, replacing the old one at once
+def write_manifest(subjects, completed, path):
+    manifest = {}
+    for subject in subjects:
+        for subtopic, content_type in iter_generation_units(subject):
+            record = completed.get(get_unit_key(subject, subtopic, content_type))
+            if record is not None:
+                manifest[f"{get_card_prefix(subject, subtopic)}_{content_type}"] = {
+                    key: value for key, value in record.items() if key != "cards"
+                }
+    with open(f"{path}.tmp", "w", encoding="utf-8") as output:
+        json.dump(manifest, output, indent=2, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+    return manifest
+
+# Function to compare the units of the subjects against a manifest, returning the cardIds
+# that are unchanged, changed (new fingerprint), added and removed
+def diff_manifest(subjects, manifest):
+    diff = {"unchanged": [], "changed": [], "added": [], "removed": []}
+    card_ids = set()
+    for subject in subjects:
+        for subtopic, content_type in iter_generation_units(subject):
+            card_id = f"{get_card_prefix(subject, subtopic)}_{content_type}"
+            card_ids.add(card_id)
+            if card_id not in manifest:
+                diff["added"].append(card_id)
+            elif manifest[card_id].get("fingerprint") == get_unit_manifest_entry(subject, subtopic, content_type)["fingerprint"]:
+                diff["unchanged"].append(card_id)
+            else:
+                diff["changed"].append(card_id)
+    diff["removed"] = [card_id for card_id in manifest if card_id not in card_ids]
+    return diff
+
+# Function to generate the checkpoint record of one unit, returning the error instead of raising it.
+# The unit's model calls are queued fairly against other subjects' calls in the same lane.
+async def run_unit_async(unit_key, subject, subtopic, content_type, semaphore, timeout):
+    try:
+        with scheduling(tenant=subject["topic"]):
+            cards = await generate_cards_async(subject, subtopic, content_type, semaphore, timeout)
+        return dict({"unit": unit_key}, **get_unit_manifest_entry(subject, subtopic, content_type), cards=cards), None
+    except Exception as error:
+        return {"unit": unit_key}, error
+
+# Function to generate every unit of many subjects, checkpointing each finished unit.
+# Units already in the checkpoint are skipped, so a crashed or throttled run resumes
+# where it stopped. Failed units are reported and left for the next run.
+# The ordered output is rebuilt from the checkpoints at the end of the run.
+# With a (index, count) shard only that shard's units are generated, into the shard's
+# own checkpoint file, and no output is written; a later run without a shard merges them.
+# With incremental only checkpointed units whose fingerprint still matches are reused,
+# so after a subject or prompt edit just the units whose inputs changed are generated.
+async def run_curriculum_async(subjects, output_path, checkpoint_path, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT, shard=None, incremental=False):
+    fingerprints = None
+    if incremental:
+        fingerprints = {unit_key: entry["fingerprint"] for unit_key, entry in get_unit_manifest_entries(subjects).items()}
+    completed = load_checkpoints(checkpoint_path, fingerprints)
+    semaphore = rate_limiter.create_semaphore(max_concurrency)
+    units = (
+        run_unit_async(unit_key, subject, subtopic, content_type, semaphore, timeout)
+        for subject in subjects
+        for subtopic, content_type in iter_generation_units(subject)
+        for unit_key in [get_unit_key(subject, subtopic, content_type)]
+        if unit_key not in completed and (shard is None or is_shard_unit(unit_key, shard))
+    )
+
+    if shard is not None:
+        checkpoint_path = get_shard_checkpoint_path(checkpoint_path, shard)
+    failed = 0
+    with open_checkpoint(checkpoint_path) as checkpoint:
+        async for task in iter_as_completed_async(units, max_concurrency):
+            record, error = task.result()
+            if error is not None:
+                failed += 1
+                print(f"Failed {record['unit']}: {error!r}", file=sys.stderr)
+                continue
+            checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            completed[record["unit"]] = record
+
+    if shard is None:
+        write_curriculum_output(subjects, completed, output_path)
+        write_manifest(subjects, completed, get_manifest_path(output_path))
+    return len(completed), failed
+
+# Function to write the reward attributes of the quiz pairs of an output file to a columnar score store
+def write_score_store(output_path, scores_path):
+    store = ScoreStore().add_cards(iter_cards_jsonl(output_path))
+    store.save(scores_path)
+    return store
+
+# Function to set up a worker process with its share of the request and token budgets, the output mode,
+# the scheduling lane and the quality gate
+def init_worker(workers, max_concurrency, structured=False, fused=False, lane=None, quality=None):
+    global rate_limiter, structured_output, fused_output, quality_threshold
+    rate_limiter = build_rate_limiter(workers, max_concurrency)
+    structured_output = structured
+    fused_output = fused
+    quality_threshold = quality
+    if lane is not None:
+        current_call.set(CallContext(lane))
+
+# Function to run one shard of the curriculum in a worker process with its own request engine.
+# Returns the failed unit count with the worker's cache and rate limiter stats.
+def run_shard(subjects, checkpoint_path, shard, max_concurrency, timeout, incremental=False):
+    _, failed = asyncio.run(run_curriculum_async(subjects, None, checkpoint_path, max_concurrency, timeout, shard, incremental))
+    return failed, response_cache.stats(), rate_limiter.stats()
+
+# Function to run the curriculum over worker processes, one hash shard of the units each.
+# The concurrency limit and rate budgets are split between the workers, and the ordered
+# output is merged from the shard checkpoints once every worker is done.
+def run_curriculum_sharded(subjects, output_path, checkpoint_path, workers, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT, incremental=False):
+    worker_concurrency = max(1, max_concurrency // workers)
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(
+            workers, worker_concurrency, structured_output, fused_output, current_call.get().lane, quality_threshold
+        )
+    ) as executor:
+        futures = [
+            executor.submit(run_shard, subjects, checkpoint_path, (index, workers), worker_concurrency, timeout, incremental)
+            for index in range(workers)
+        ]
+        results = [future.result() for future in futures]
+
+    failed = 0
+    for index, (shard_failed, cache_stats, limiter_stats) in enumerate(results):
+        failed += shard_failed
+        print(f"Shard {index}/{workers}: failed units: {shard_failed}, response cache: {cache_stats}, rate limiter: {limiter_stats}")
+
+    fingerprints = None
+    if incremental:
+        fingerprints = {unit_key: entry["fingerprint"] for unit_key, entry in get_unit_manifest_entries(subjects).items()}
+    completed = load_checkpoints(checkpoint_path, fingerprints)
+    write_curriculum_output(subjects, completed, output_path)
+    write_manifest(subjects, completed, get_manifest_path(output_path))
+    return len(completed), failed
+
+# Sample subject input to test the function
+subject = {
+    "topic": "GPU Computing",
+    "skill_name": "Advanced Computing Skills",
+    "subtopics": [
+        {"name": "Parallel Processing", "analogy": True,  "assignment": True},
+        {"name": "CUDA Programming", "analogy": True, "codeSnippet": True, "quiz": True},
+    ]
+}
+
+# Function to run the curriculum runner from the command line, or the sample subject without arguments
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate and score curriculum cards.")
+    parser.add_argument("subjects", nargs="?", help="JSON or JSON Lines file of subjects")
+    parser.add_argument("-o", "--output", default="cards.jsonl", help="JSON Lines file the cards are written to")
+    parser.add_argument("--checkpoint", help="checkpoint file of finished units (default: <output>.checkpoint)")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="seconds per model call")
+    parser.add_argument("--dry-run", action="store_true", help="print the planned calls and token budget only")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each running one shard of the units")
+    parser.add_argument("--shard", type=parse_shard, help="INDEX/COUNT: only run this shard, e.g. one per node on a shared filesystem")
+    parser.add_argument("--structured", action="store_true", help="request schema-validated JSON cards and repair invalid answers")
+    parser.add_argument("--fused", action="store_true", help="generate all content types of a subtopic in one structured call")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="only regenerate units whose prompt, model or parameters changed since the manifest (<output>.manifest)"
+    )
+    parser.add_argument(
+        "--lane", choices=LANES, default="bulk",
+        help="scheduling lane of the run's model calls; interactive calls in the same process are served first"
+    )
+    parser.add_argument(
+        "--quality-gate", type=float, metavar="HELPFULNESS",
+        help="score each text card as it is generated and regenerate or hedge cards below this reward helpfulness"
+    )
+    parser.add_argument("--scores", help="write the reward attributes of the output's quiz pairs to this columnar score store")
+    parser.add_argument("--metrics", help="write per-stage latency, token and cache metrics to this JSON file")
+    parser.add_argument("--trace", help="write a Chrome trace (chrome://tracing, Perfetto) of the run to this file")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and args.shard is not None:
+        parser.error("--workers and --shard cannot be combined")
+    if args.fused and args.quality_gate is not None:
+        parser.error("--fused and --quality-gate cannot be combined: fused cards are not gated")
+    global structured_output, fused_output, quality_threshold
+    structured_output = args.structured
+    fused_output = args.fused
+    quality_threshold = args.quality_gate
+    subjects = load_subjects(args.subjects) if args.subjects else [subject]
+    if args.dry_run:
+        print_generation_plan([unit for item in subjects for unit in build_generation_plan(item)])
+        return 0
+
+    if args.metrics or args.trace:
+        tracer.enable()
+    try:
+        with scheduling(lane=args.lane):
+            return run_main(args, subjects)
+    finally:
+        if args.metrics:
+            tracer.write_metrics(args.metrics)
+        if args.trace:
+            tracer.write_chrome_trace(args.trace)
+
+# Function to generate the sample subject or run the curriculum of the parsed command line
+def run_main(args, subjects):
+    if not args.subjects:
+        # Generate the subtopic array with responses
+        subtopic_cards = asyncio.run(generate_subtopic_array_async(subject, args.max_concurrency, args.timeout))
+
+        # Print the generated cards for inspection
+        for card in subtopic_cards:
+            print(card)
+        print(f"Response cache: {response_cache.stats()}")
+        print(f"Rate limiter: {rate_limiter.stats()}")
+        return 0
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    if args.incremental:
+        diff = diff_manifest(subjects, load_manifest(get_manifest_path(args.output)))
+        print("Manifest diff: " + ", ".join(f"{kind}: {len(card_ids)}" for kind, card_ids in diff.items()))
+        for card_id in diff["changed"] + diff["added"]:
+            print(f"Regenerating {card_id}")
+    if args.workers > 1:
+        completed, failed = run_curriculum_sharded(
+            subjects, args.output, checkpoint_path, args.workers, args.max_concurrency, args.timeout, args.incremental
+        )
+        print(f"Completed units: {completed}, failed units: {failed}")
+    else:
+        completed, failed = asyncio.run(
+            run_curriculum_async(subjects, args.output, checkpoint_path, args.max_concurrency, args.timeout, args.shard, args.incremental)
+        )
+        print(f"Completed units: {completed}, failed units: {failed}")
+        print(f"Response cache: {response_cache.stats()}")
+        print(f"Rate limiter: {rate_limiter.stats()}")
+    if args.scores and args.shard is None:
+        store = write_score_store(args.output, args.scores)
+        print(f"Score store: {len(store)} pairs, helpfulness win rates: {store.win_rates()}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
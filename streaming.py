@@ -0,0 +1,122 @@
+import bisect
+import time
+
+# Longest text still checked for an empty JSON object answer
+EMPTY_JSON_MAX_LENGTH = 16
+
+# Response text assembled from streamed chunks. Chunks are kept in a list and
+# only joined when the text is read, instead of copying the whole response on
+# every delta. on_delta sees each delta as it arrives and stop_condition is
+# checked after every delta so the stream can be closed early.
+class StreamingResponse:
+    def __init__(self, stop_condition=None, on_delta=None):
+        self.stop_condition = stop_condition
+        self.on_delta = on_delta
+        self.chunks = []
+        self.offsets = []
+        self.length = 0
+        self.stopped = False
+        self.first_delta_time = None
+        self.state = {}  # kept by stop conditions between deltas
+        self._text = None
+        self._finds = {}
+
+    # Function to add a streamed delta, returning True once the stop condition is met
+    def append(self, delta):
+        if self.first_delta_time is None:
+            self.first_delta_time = time.perf_counter()
+        self.offsets.append(self.length)
+        self.chunks.append(delta)
+        self.length += len(delta)
+        self._text = None
+        if self.on_delta is not None:
+            self.on_delta(delta)
+        if self.stop_condition is not None and self.stop_condition(self):
+            self.stopped = True
+        return self.stopped
+
+    # The text received so far; the chunks are collapsed into one after joining
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = "".join(self.chunks)
+            self.chunks = [self._text]
+            self.offsets = [0]
+        return self._text
+
+    # Function to get the text from a character offset to the end
+    def suffix(self, start):
+        index = max(0, bisect.bisect_right(self.offsets, start) - 1)
+        return "".join(self.chunks[index:])[start - self.offsets[index]:] if self.chunks else ""
+
+    # Function to find a pattern at or after start, only scanning text that arrived since the last call
+    def find(self, pattern, start=0):
+        key = (pattern, start)
+        found, scanned = self._finds.get(key, (-1, start))
+        if found < 0 and self.length > scanned:
+            window_start = max(start, scanned - len(pattern) + 1)
+            index = self.suffix(window_start).find(pattern)
+            found = window_start + index if index >= 0 else -1
+            self._finds[key] = (found, self.length)
+        return found
+
+# Incremental scanner of a streamed JSON value that tracks the nesting depth
+# outside strings, so the end of the top-level object is found as it arrives.
+# Text before the first "{" is skipped, as card_schema.extract_json does, so
+# brackets in a preamble do not end the stream before the object arrives.
+class JsonScanner:
+    def __init__(self):
+        self.position = 0
+        self.started = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+
+    # Function to scan the next piece of text, returning True once the top-level value is closed
+    def feed(self, text):
+        self.position += len(text)
+        for char in text:
+            if self.complete:
+                break
+            if not self.started:
+                if char == "{":
+                    self.started = True
+                    self.depth = 1
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]" and self.depth > 0:
+                self.depth -= 1
+                self.complete = self.depth == 0
+        return self.complete
+
+# Stop condition: the model answered with an empty JSON object (TEXT_PROMPT rule 8)
+def is_empty_json_object(response):
+    return response.length <= EMPTY_JSON_MAX_LENGTH and is_empty_json_text(response.text)
+
+# Function to tell whether a finished answer is the empty JSON object (TEXT_PROMPT rule 8)
+def is_empty_json_text(text):
+    return len(text) <= EMPTY_JSON_MAX_LENGTH and text.strip() == "{}"
+
+# Stop condition: the RESPONSE B: section is closed by a blank line, after which
+# parse_response_pair ignores the rest of the response set
+def is_response_b_complete(response):
+    marker = response.find("RESPONSE B:")
+    return marker >= 0 and response.find("\n\n", marker + len("RESPONSE B:")) >= 0
+
+# Stop condition: the top-level JSON object of a structured answer is closed, after
+# which only code fences or chatter that parse_structured drops could follow
+def is_json_complete(response):
+    scanner = response.state.get("json")
+    if scanner is None:
+        scanner = response.state["json"] = JsonScanner()
+    return scanner.feed(response.suffix(scanner.position))
@@ -0,0 +1,189 @@
+import asyncio
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+
+# Span attributes summed per span name in the metrics report
+SUMMED_ATTRIBUTES = ["tokens_in", "tokens_out", "attempts"]
+
+# Function to compute the nearest-rank percentile of a list of values
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+# Span returned while tracing is disabled: every method is a no-op
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+NULL_SPAN = NullSpan()
+
+# Timed section of a run with free-form attributes such as tokens, cache hits or attempts
+class Span:
+    __slots__ = ("tracer", "name", "attributes", "start", "end", "track", "_token")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.end = None
+        self.track = None
+        self._token = None
+
+    def __enter__(self):
+        self.track = self.tracer.get_track()
+        self._token = self.tracer.current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.end = time.perf_counter()
+        if error_type is not None:
+            self.attributes["error"] = error_type.__name__
+        self.tracer.current_span.reset(self._token)
+        self.tracer.record(self)
+        return False
+
+    # Function to set an attribute of the span
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    # Function to add to a numeric attribute of the span
+    def add(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+# Collector of spans for the metrics report and the Chrome trace export.
+# While disabled, span() and current() hand out NULL_SPAN, so instrumented code
+# only pays for one attribute check per call.
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.origin = time.perf_counter()
+        self.current_span = contextvars.ContextVar("current_span", default=NULL_SPAN)
+        self._tracks = {}
+        self._lock = threading.Lock()
+
+    # Function to start collecting spans, dropping earlier ones
+    def enable(self):
+        with self._lock:
+            self.spans = []
+            self._tracks = {}
+            self.origin = time.perf_counter()
+            self.enabled = True
+
+    # Function to stop collecting spans
+    def disable(self):
+        self.enabled = False
+
+    # Function to open a span as a context manager
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    # Function to get the innermost open span of the current task or thread
+    def current(self):
+        if not self.enabled:
+            return NULL_SPAN
+        return self.current_span.get()
+
+    # Function to store a finished span
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    # Function to get a small track number for the current asyncio task or thread
+    def get_track(self):
+        try:
+            owner = asyncio.current_task()
+        except RuntimeError:
+            owner = None
+        key = id(owner) if owner is not None else threading.get_ident()
+        with self._lock:
+            return self._tracks.setdefault(key, len(self._tracks) + 1)
+
+    # Function to aggregate the spans per name: latency percentiles, TTFT, summed token and attempt counts, cache hits
+    def get_metrics(self):
+        with self._lock:
+            spans = list(self.spans)
+        groups = {}
+        for span in spans:
+            groups.setdefault(span.name, []).append(span)
+
+        summary = {}
+        for name, group in groups.items():
+            durations = [span.end - span.start for span in group]
+            ttfts = [span.attributes["ttft"] for span in group if "ttft" in span.attributes]
+            metrics = {
+                "count": len(group),
+                "total_seconds": round(sum(durations), 6),
+                "p50": percentile(durations, 0.50),
+                "p95": percentile(durations, 0.95),
+                "p99": percentile(durations, 0.99),
+                "max": max(durations),
+                "errors": sum(1 for span in group if "error" in span.attributes),
+                "cache_hits": sum(1 for span in group if span.attributes.get("cache_hit"))
+            }
+            for attribute in SUMMED_ATTRIBUTES:
+                values = [span.attributes[attribute] for span in group if attribute in span.attributes]
+                if values:
+                    metrics[attribute] = sum(values)
+            if "attempts" in metrics:
+                metrics["retries"] = sum(max(0, span.attributes.get("attempts", 1) - 1) for span in group)
+            if ttfts:
+                metrics["ttft_p50"] = percentile(ttfts, 0.50)
+                metrics["ttft_p95"] = percentile(ttfts, 0.95)
+            summary[name] = metrics
+
+        return {
+            "stages": summary,
+            "calls": [
+                dict(span.attributes, name=span.name, start=round(span.start - self.origin, 6), duration=round(span.end - span.start, 6))
+                for span in spans
+            ]
+        }
+
+    # Function to write the metrics report as JSON
+    def write_metrics(self, path):
+        with open(path, "w", encoding="utf-8") as output:
+            json.dump(self.get_metrics(), output, indent=2, default=str)
+
+    # Function to write the spans in the Chrome trace event format (chrome://tracing, Perfetto)
+    def write_chrome_trace(self, path):
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = [
+            {
+                "name": span.name,
+                "cat": span.name.split(":")[0],
+                "ph": "X",
+                "ts": round((span.start - self.origin) * 1e6, 3),
+                "dur": round((span.end - span.start) * 1e6, 3),
+                "pid": pid,
+                "tid": span.track,
+                "args": span.attributes
+            }
+            for span in spans
+        ]
+        with open(path, "w", encoding="utf-8") as output:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, output, default=str)
+
+# Shared tracer used by the instrumented pipeline
+tracer = Tracer()